@@ -18,13 +18,32 @@ DCSTEPS = 12        # number of +/- button presses to reach full forward speed:
 DCMIN = 25          # min dc power (%) to move the train - can be changed in program ! ( range 10 - 40 )
 DCMAX = 80          # max forward dc power (%) to keep the train stay on the track ( range 41 - 90 (hard code limit) )
 DCMAXR = 50         # max reverse dc power (%) ( range 0 - 90 (hard code limit)) - set to 0 for trams ?
-DCACC = 20          # acceleration - 1 (aggressive) - 80 (gentle) - try 20
+CURVE = "linear"    # forward speed curve: "linear", "soft" ( finer steps at low speed ) or "scurve" ( finer at both ends )
+CURVER = "linear"   # reverse speed curve: "linear", "soft" or "scurve"
+ACCEL = 20          # acceleration in dc % per second - 5 (gentle) - 100 (aggressive) ( range 1 - 200 )
+DECEL = 40          # deceleration in dc % per second when slowing down or stopping ( range 1 - 200 )
+SPEEDCONTROL = False # Technic ( encoder ) motors hold the speed against grades and load - DC train motors always run open loop. DCMIN, DCMAX and the ramp then mean % of SPEEDMAX, so calibrate DCMIN again by hand
+SPEEDMAX = 1000     # motor speed in deg/s at 100% for SPEEDCONTROL ( range 100 - 2000 )
+VNOMINAL = 0        # battery mV the speeds are set up for - DC motors get more dc as the cells run down - 0 for off ( range 5000 - 9000, try 7200 )
+JERK = 0            # how fast the acceleration builds up in %/s per second for softer starts - 0 for off ( range 0 - 1000 )
+DCTICK = 50         # ms between motor updates - lower is smoother, the ramp feels the same ( range 10 - 500 )
+OVERCURRENT = 1500  # mA hub current that counts as an overload - the power is cut ( range 500 - 3000 )
 BRAKE = 600         # ms delay after stopping to prevent overruns ( range 1 - 2000 ms )
+BUTTONHOLD = 350    # ms a +/- button is held down before it starts repeating ( range 100 - 2000 ms )
+BUTTONREPEAT = 100  # ms between repeats while a +/- button is held down ( range 20 - 1000 ms )
 BROADCASTCHANNEL = None  # channel for 2nd hub ( 0 - 255 ) Use None if no other hub consumes power !
+FOLLOWRAMP = True   # 2nd hub runs the inertia ramp itself from the target - far fewer broadcasts ( True or False )
+FOLLOWERS = 0       # number of pytrainfollow.py hubs reporting back on channels BROADCASTCHANNEL + 1, + 2 .. ( range 0 - 8 )
+SYNCLEAD = 0        # ms a speed change is scheduled ahead so the followers start it at the same moment - 0 for off ( range 0 - 255, try 150 )
+BALANCE = False     # followers adjust their power to share the load evenly ( True or False )
+BROADCASTRATE = 100 # min ms between updates to the 2nd hub and remote light - changes in between are merged ( range 10 - 1000 )
+REMOTELOST = "stop" # what the train does if the remote drops out until it is found again: "stop", "crawl" or "keep" ( its speed )
 INACTIVITY = 5      # mins before shutdown if no button pressed and train stationary, try 5
 dirmotorA = -1      # Hub motor A Direction clockwise 1 or -1
 dirmotorB = 1       # Hub motor B Direction clockwise 1 or -1
 OUTPUT = False      # set to true to show extra info for debugging - True or False
+PROFILE = 0         # timings kept per task to find what holds up the drive loop - hold the right red button for a report - 0 for off ( range 0 - 500 )
+TRACE = 0           # records of cc, target, dc and voltage kept in memory for debugging - the right red button dumps them - 0 for off ( range 0 - 2000 )
 
 # ----------
 # --- Main programme
@@ -34,133 +53,624 @@ OUTPUT = False      # set to true to show extra info for debugging - True or Fal
 # --- modules
 from pybricks.parameters import Color, Button, Direction, Port
 from pybricks.pupdevices import DCMotor, Motor, Remote
-from pybricks.tools import multitask, run_task, wait
-from umath import copysign
+from pybricks.tools import multitask, run_task, wait, StopWatch
 from pybricks.iodevices import PUPDevice
 from pybricks.hubs import ThisHub
+import ustruct
+import gc
+from usys import stdout
 
 # ----------
 # --- functions
 # ----------
 
-async def drive(target):
+def drive(target, dt):
     """
-    Adjusts the motor speed to the target duty cycle with simulated inertia.
+    Moves the motor speed towards the target duty cycle with simulated inertia.
+    Time based: dc changes at ACCEL %/s when speeding up and DECEL %/s when
+    slowing down, so the ramp feels the same whatever the update rate.
+    JERK limits how quickly the rate itself builds up.
+    Integer maths only - the part of a step smaller than 1% is carried over in rest.
 
     Args:
         target (int): The target duty cycle.
+        dt (int): ms since the last update
     """    
-    global dc , cc 
-   
-    await wait(0)
-
-    # 2 deltas for accel and decel
-    smooth1 = 3 #  2 - 10 , try 4 - this defines the agressiveness of accel - higher is smoother
-    smooth2 = 3 #  2 - 10 , try 3 - this defines the agressiveness of decel - decrease for faster response
+    global rate, faster, rest
 
-    delta1 = max(1,round(abs(target - dc)/smooth1)) 
-    delta2 = max(1,round(abs(target - dc)/smooth2)) 
+    # kickstart - the train doesn't move below this anyway
+    # and kickstop to prevent long tail slowdown blocking responsiveness
+    dckick = ((DCMIN if (dc or target) > 0 else DCMINR) + 1) // 2
 
-    dckickstart = round(DCMIN / 2) # kickstart in case delta very small 
-    dckickstop = round(DCMIN / 2) # kickstop to prevent long tail slowdown blocking responsiveness
+    # speeding up is moving away from 0 in the direction of the target
+    up = abs(target) > abs(dc) and target * dc >= 0
+    limit = (ACCEL if up else DECEL) * 1000 # in 1/1000 % per second
 
-    # positive change
-    if target > dc: 
-        if dc >= 0: #forward accel
-            newdc = max(dckickstart, dc + delta1) 
-        elif dc < -dckickstop: #reverse decel
-            newdc = dc + delta2
-        else:
-            newdc = 0
-    # negative change
+    # jerk limit - the rate builds up from 0 each time the train starts speeding up or slowing down
+    if JERK:
+        if up != faster: rate = 0
+        rate = min(limit, rate + JERK * dt)
     else:
-        if dc <= 0: #accel reverse
-            newdc = min(-dckickstart,dc - delta1) 
-        elif dc > dckickstop: #forward decel
-            newdc = dc - delta2
-        else:
+        rate = limit
+    faster = up
+
+    step = rate * dt // 1000 + rest # in 1/1000 %
+    rest = step % 1000
+    step = step // 1000
+
+    if up and dc == 0:
+        newdc = max(dckick, step)
+        if target < 0: newdc = -newdc
+    elif abs(target - dc) <= step:
+        newdc = target
+    else:
+        newdc = dc + step if target > dc else dc - step
+        # stop at 0 before reversing
+        if not up and (newdc * dc < 0 or abs(newdc) < dckick):
             newdc = 0
+
+    if newdc == target: 
+        rate = 0
+        rest = 0
     
     if (OUTPUT): print("dc target:",target,"actual dc",newdc,"controller",cc)
-    
-    # hard code dc safety limit during development ( and maybe permanent )
-    newdc = copysign(min(90,abs(newdc)),newdc)
 
-    # hard limit on reverse max dc - should be done via asymmetric dcprofiles
-    if newdc < -DCMAXR: 
-        newdc = -DCMAXR
-        cc += 1 # prevent racing to un unreachable target dc ( from cc )
-        if (OUTPUT): print("reverse speed limit reached:",DCMAXR)
+    power(newdc)
+    if TRACE: trace(TASK_DRIVE)
+
+def power(newdc):
+    """
+    Applies the safety limits and sends a duty cycle to the motors
+
+    Args:
+        newdc (int): The new duty cycle.
+    """
+    global dc, dirty
+
+    # hard code dc safety limit during development ( and maybe permanent )
+    # reverse is already limited to DCMAXR by the ramp table
+    if newdc > 90: newdc = 90
+    elif newdc < -90: newdc = -90
 
     #update global
+    # with FOLLOWRAMP the 2nd hub ramps by itself - only targets are sent
+    if newdc != dc and not FOLLOWRAMP: dirty |= DIRTY_FRAME
     dc = newdc
 
+    # battery compensation - vfactor and vlimit are kept up to date by battery()
+    out = min(abs(dc) * vfactor // 1000, vlimit)
+    if dc < 0: out = -out
+
     # send drive command to motors 1 and 2
     for m in motor:
         #print (m)
-        if (m): m.dc(dc)
+        if not m: continue
+        # the ramp in % of SPEEDMAX - the motor's own control loop holds the speed
+        if SPEEDCONTROL and isinstance(m, Motor):
+            if dc: m.run(dc * SPEEDMAX // 100)
+            else: m.stop()
+        else:
+            m.dc(out)
+
+async def battery():
+    """
+    Samples the battery every VSAMPLE ms into mv and filters out the
+    short dips - also run for TRACE alone. With VNOMINAL works out vfactor so
+    the motors see the same voltage as at VNOMINAL, and lowers vlimit once
+    the cells are below VDERATE % of it
+    """
+    global vfactor, vlimit, mv
+
+    await wait(0)
+
+    vlow = VNOMINAL * VDERATE // 100
+
+    while True:
+        mv += (hub.battery.voltage() - mv) // VFILTER
+
+        if not VNOMINAL:
+            await wait(VSAMPLE)
+            continue
+
+        factor = max(VFACTORMIN, min(VFACTORMAX, VNOMINAL * 1000 // mv))
+        limit = 90 if mv >= vlow else max(DCMIN, 90 * mv // vlow)
+
+        if factor != vfactor or limit != vlimit:
+            vfactor = factor
+            vlimit = limit
+            if (OUTPUT): print("battery",mv,"mV - dc x",vfactor/1000,"max",vlimit)
+            if dc: power(dc)
+            if TRACE: trace(TASK_BATTERY)
+
+        await wait(VSAMPLE)
 
 async def broadcast():
     """
     BT commands cannot be simultaneous:
-    Activate and update 100ms system broadcast of dc and light values
-    Send light colour to remote 
+    Sends a frame to the 2nd hub and the light colour to the remote when they change
+    Sleeps until a dirty flag is set, then merges bursts of changes into
+    one update every BROADCASTRATE ms. Failed sends are retried with backoff -
+    the frame and the light each have their own, so a remote that won't take
+    the light never holds back a frame ( an emergency stop least of all )
+
+    Frame ( FRAME_FORMAT, 10 bytes ): sequence number, command | state << 4,
+    target dc, dc, light, load, clock ms, ms until the target applies, latency
+    - the sequence number moves on with every frame sent, so the followers
+    take each one, clock sample included
+    With FOLLOWRAMP ( RAMP_FORMAT, 16 bytes ) DCMIN, DCMINR, ACCEL, DECEL and JERK
+    follow, and frames are only sent when the target or command change -
+    with SYNCLEAD also every SYNCRATE ms with the same data, for the clock estimate
     """
+    global dirty, seq, seqat, remoteshown
+
     await wait(0)
  
-    thisdc = 0
-    thislight = Color.BLUE
+    framebackoff = RETRY # ms to the next retry of a failed frame / light
+    lightbackoff = RETRY
+    frameretry = 0 # clock ms before which a failed frame / light isn't tried again
+    lightretry = 0
 
     while True:
-        await wait(0)
+        # SYNCLEAD needs a steady flow of clock samples at the followers
+        now = clock.time()
+        if SYNCLEAD and not BROADCASTCHANNEL is None and now - seqat >= SYNCRATE:
+            dirty |= DIRTY_FRAME
+
+        # nothing to do until drive() or status() mark a change, or a backoff is over
+        flags = dirty
+        if now < frameretry: flags &= ~DIRTY_FRAME
+        if now < lightretry: flags &= ~DIRTY_LIGHT
+        if not flags:
+            await wait(0)
+            continue
+        dirty &= ~flags
+
+        if flags & DIRTY_FRAME and not BROADCASTCHANNEL is None:   # 0 is a valid channel
+            try:
+                seq = (seq + 1) & 0xFF
+                now = clock.time()
+                lead = min(255, max(0, applyat - now))
+                if FOLLOWRAMP:
+                    frame = ustruct.pack(RAMP_FORMAT, seq, command | state << 4, target, dc, light, load,
+                                         now & 0xFFFF, lead, latency, DCMIN, DCMINR, ACCEL, DECEL, JERK)
+                else:
+                    frame = ustruct.pack(FRAME_FORMAT, seq, command | state << 4, target, dc, light, load,
+                                         now & 0xFFFF, lead, latency)
+                await hub.ble.broadcast(frame)
+                seqat = now
+                framebackoff = RETRY
+                if (OUTPUT): print("broadcast frame",seq,command,state,target,dc,light)
+                if TRACE: trace(TASK_BROADCAST)
+            except OSError as ex:
+                if (OUTPUT): print ("broadcast error - retry in",framebackoff,"ms",ex)
+                dirty |= DIRTY_FRAME # send again after the backoff, with the data of then
+                frameretry = clock.time() + framebackoff
+                framebackoff = min(framebackoff * 2, RETRYMAX)
 
-        if not BROADCASTCHANNEL is None:   # 0 is a valid channel
-            if thisdc != dc:
+        # a lost remote gets the light once reconnect() has found it again
+        if flags & DIRTY_LIGHT and remoteup and remoteshown != remotelight:
+            try:
+                led = remotelight
+                await remote.light.on(led)
+                remoteshown = led
+                lightbackoff = RETRY
+            except OSError as ex:
+                if (OUTPUT): print ("remote light error - retry in",lightbackoff,"ms",ex)
+                dirty |= DIRTY_LIGHT
+                lightretry = clock.time() + lightbackoff
+                lightbackoff = min(lightbackoff * 2, RETRYMAX)
 
-                bdata = (dc, 0)
+        # changes made while waiting here go out together in the next update
+        await wait(BROADCASTRATE)
 
-                try:
-                    await hub.ble.broadcast(bdata)
-                    thisdc = dc
-                    if (OUTPUT): print("broadcast data updated",bdata)
-                except OSError as ex:
-                    if (OUTPUT): print ("broadcast error 1",ex)
+async def consist():
+    """
+    Observes the telemetry of the FOLLOWERS hubs every REPORTPOLL ms
+    Works out the mean load of the consist for BALANCE and makes a safe stop
+    if a following hub stops reporting or stops receiving while the train moves
+    Each report carries the follower's estimate of the clock here: the
+    shortest round trip seen gives the radio latency sent out for SYNCLEAD
+    """
+    global cc, load, latency, dirty
+
+    await wait(0)
 
-        if thislight != remotelight:
+    reports = [None] * FOLLOWERS # last TELEMETRY_FORMAT report of each unit - None until heard from
+    seen = [0] * FOLLOWERS # clock ms the report last changed
+    trip = [None] * FOLLOWERS # shortest round trip of each unit in ms
 
+    while True:
+        now = clock.time()
+        total = hub.battery.current()
+        count = 1
+
+        for i in range(FOLLOWERS):
             try:
-                await remote.light.on(remotelight)
-                thislight = remotelight
-            except OSError as ex:
-                if (OUTPUT): print ("remote light error 1",ex)
-                
-        await wait(0)
+                data = hub.ble.observe(BROADCASTCHANNEL + 1 + i)
+            except OSError:
+                data = None
+
+            # the report counter moves on with every report, so a repeat is an old one
+            if data is not None and len(data) == TELEMETRY_SIZE and (reports[i] is None or data[0] != reports[i][0]):
+                if reports[i] is None: print("unit",i+1,"reporting")
+                reports[i] = ustruct.unpack(TELEMETRY_FORMAT, data)
+                seen[i] = now
+
+                # frame out + report back - creeps up slowly so a changed latency is followed
+                back = ((now - reports[i][7] + 0x8000) & 0xFFFF) - 0x8000
+                trip[i] = back if trip[i] is None or back < trip[i] else trip[i] + 1
+                if (OUTPUT): print("unit",i+1,"dc",reports[i][2],"applied",reports[i][3],"mV",reports[i][4],
+                                   "mA",reports[i][5],"skew",reports[i][8],"ms")
+
+            report = reports[i]
+            if report is None or not report[6] & UNIT_JOINED:
+                continue
+
+            if now - seen[i] > LOSTTIME or (report[1] != seq and now - seqat > LOSTTIME):
+                print("unit",i+1,"lost")
+                reports[i] = None
+                if cc != 0 or dc != 0:
+                    # safe stop - ramp down as for the stop button
+                    cc = 0
+                    stop()
+                    emergency(False)
+                continue
+
+            total += report[5]
+            count += 1
+
+        # the followers compare their own load with the mean
+        if BALANCE:
+            mean = min(255, total // count // LOAD_UNIT)
+            if abs(mean - load) > 1:
+                load = mean
+                dirty |= DIRTY_FRAME
+
+        # one way latency - goes out with the next frame
+        shortest = None
+        for t in trip:
+            if t is not None and (shortest is None or t < shortest): shortest = t
+        if shortest is not None: latency = min(255, max(0, shortest // 2))
+
+        await wait(REPORTPOLL)
+
+def trace(task):
+    """
+    Adds a record to the TRACE ring buffer - the oldest is overwritten once it is full
+    Packed in place with pack_into, so nothing is allocated in the drive loop
+
+    Args:
+        task(int): TASK_ of the caller
+    """
+    global tracepos
+
+    ustruct.pack_into(TRACE_FORMAT, tracebuf, tracepos % TRACE * TRACE_SIZE,
+                      clock.time(), cc, target, dc, mv, task)
+    tracepos += 1
+
+def dump():
+    """
+    Writes the TRACE records, oldest first, to stdout as one binary frame:
+    TRACE_HEADER then count records of TRACE_FORMAT.
+    Capture the output on the computer and decode it with python -m sim.trace
+    """
+    count = min(tracepos, TRACE)
+    start = (tracepos - count) % TRACE * TRACE_SIZE
+    end = start + count * TRACE_SIZE
+    records = memoryview(tracebuf)
+
+    stdout.buffer.write(ustruct.pack(TRACE_HEADER, TRACE_MAGIC, TRACE_VERSION, TRACE_SIZE, count))
+    if end <= len(tracebuf):
+        stdout.buffer.write(records[start:end])
+    else:
+        # wrapped - the oldest records are at the end of the buffer
+        stdout.buffer.write(records[start:])
+        stdout.buffer.write(records[:end - len(tracebuf)])
+    print("trace:",count,"records")
+
+class Profile:
+    """
+    Runs one task for PROFILE and times it: the ms it runs for, added up per task and
+    per loop pass of multitask() ( the first task starts a pass ), and through profwait()
+    how late the task woke up compared with the wait() it asked for.
+    The clock counts whole ms, so a single resume mostly reads 0 - a loop pass is
+    the smallest span timed. The last PROFILE samples are kept in buffers allocated up front
+
+    Args:
+        name(string): task name for the report
+        coro(coroutine): the task
+    """
+    def __init__(self, name, coro):
+        self.name = name
+        self.coro = coro
+        self.resumes = 0
+        self.busy = 0 # ms spent in the task
+        self.slowest = 0 # ms of the longest resume - a blocking call shows here
+        self.late = bytearray(PROFILE * 2) # ms late of each wake up
+        self.wakes = 0
+        
+    def __await__(self):
+        return self
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self.send(None)
+
+    def send(self, value):
+        global running, passstart, passend, passes
+
+        running = self
+        start = clock.time()
+        if self is tasks[0]:
+            # a new loop pass - the last one ran from its first resume to the end of its last
+            if passes: ustruct.pack_into("<H", passrun, (passes - 1) % PROFILE * 2, min(passend - passstart, 0xFFFF))
+            passstart = start
+            passes += 1
+        try:
+            return self.coro.send(value)
+        finally:
+            passend = clock.time()
+            ms = passend - start
+            self.busy += ms
+            if ms > self.slowest: self.slowest = ms
+            self.resumes += 1
+
+    def close(self):
+        self.coro.close()
+
+    def woke(self, ms):
+        """Adds a wake up ms late"""
+        ustruct.pack_into("<H", self.late, self.wakes % PROFILE * 2, min(max(ms, 0), 0xFFFF))
+        self.wakes += 1
+
+async def profwait(time):
+    """
+    wait() while PROFILE is on - notes how late the running task wakes up
+
+    Args:
+        time(int): ms to wait
+    """
+    task = running
+    due = clock.time() + time
+    await taskwait(time)
+    task.woke(clock.time() - due)
+
+def percentiles(samples, count):
+    """
+    Median, 90th, 99th percentile and max of the newest count samples in a Profile buffer
+
+    Args:
+        samples(bytearray): "<H" samples
+        count(int): samples written so far
+    """
+    values = sorted(ustruct.unpack_from("<H", samples, i * 2)[0] for i in range(min(count, PROFILE)))
+    if not values: return (0, 0, 0, 0)
+    n = len(values)
+    return (values[n // 2], values[n * 9 // 10], values[n * 99 // 100], values[-1])
+
+def profile():
+    """
+    Prints the PROFILE report: resumes, share of the time, how late each task woke up
+    ( ms: median / 90% / 99% / max ) and its longest resume, then how long the loop passes ran
+    """
+    elapsed = max(1, clock.time() - profiled)
+    print("profile:",elapsed,"ms - ms clock: times below 1 ms read 0, a wait(0) is always one loop pass late")
+    print("task       resumes  cpu%  late 50/90/99/max  slowest")
+    for task in tasks:
+        late = percentiles(task.late, task.wakes)
+        print("{:10} {:7} {:5.1f}  {:>17}  {:7}".format(task.name, task.resumes,
+              100 * task.busy / elapsed, "/".join(str(x) for x in late), task.slowest))
+    run = percentiles(passrun, passes - 1)
+    print("loop passes",passes,"- ms run 50/90/99/max:","/".join(str(x) for x in run))
+    print("drive ticks over",DRIVEBUDGET,"bytes:",overbudget,"max",overbytes,
+          "- free heap",gc.mem_free(),"low",heaplow,"collections",collections)
+
+async def collect():
+    """
+    Garbage collection on our terms, only while ems() is idle with dc on target:
+    every GCIDLE ms while the train is stationary, and when cruising once half the heap
+    left after the last collection is used. So every ramp starts with heap to spare and
+    the automatic collection isn't due mid ramp.
+    Keeps the lowest free heap seen ( heaplow ) and warns below GCLOW
+    """
+    global heaplow, collections
+
+    await wait(0)
+
+    last = clock.time()
+    after = gc.mem_free() # free heap after the last collection
+
+    while True:
+        if dc == target and not estop:
+            free = gc.mem_free()
+            if free < heaplow:
+                heaplow = free
+                if heaplow < GCLOW: print("low memory:",heaplow,"bytes free")
+
+            if free < after // 2 or (dc == 0 and clock.time() - last >= GCIDLE):
+                gc.collect()
+                collections += 1
+                last = clock.time()
+                after = gc.mem_free()
+                if (OUTPUT): print("gc: free",free,"->",after,"bytes")
+
+        await wait(GCPOLL)
+
+def status(led, mode):
+    """
+    Sets the hub light and marks led and mode to be sent by broadcast()
+
+    Args:
+        led(Color): status colour
+        mode(int): STATE_ value for the 2nd hub
+    """
+    global remotelight, state, dirty
+
+    remotelight = led
+    state = mode
+    dirty |= DIRTY_LIGHT | DIRTY_FRAME
+    hub.light.on(led)
+
+def curve(shape, x):
+    """
+    Speed curve shapes for dcprofile()
+
+    Args:
+        shape (string): "linear", "soft" or "scurve"
+        x (float): position along the ramp 0 - 1
+
+    Returns:
+        float: share of the range from DCMIN to max 0 - 1
+    """
+    if shape == "soft":
+        return x * x
+    if shape == "scurve":
+        return x * x * (3 - 2 * x)
+    return x
 
 def dcprofile(mode):
     """
     # Set up s discrete duty cycle steps from threshold (DCMIN) to DCMAX 
-    # Map the loco power curve - for now threshold and then linear 
+    # and from DCMINR to DCMAXR in reverse, each direction with its own curve
     # This is also called if threshold DCMIN is changed live
+    # Built once into one tuple of integers so ems() only needs dcramp[cc + rampzero]
 
     Args:
         mode (string):  Build normal dcramp or granular for calibration
     """
-    global dcramp
-
-    dcramp={} #reset
+    global dcramp, rampzero, ccmin, ccmax
 
     if mode =="calibrate":
-        for x in range(0,50):
-            dcramp[x] = x
+        dcramp = tuple(range(0,50))
+        rampzero = 0
+        ccmin = 0
+        ccmax = 49
     
     else:
-        dcramp[0] = 0
-        dcramp[1] = DCMIN
+        forward = [0, DCMIN]
         for x in range(1,DCSTEPS+1):
-            dcramp[x+1] = round( DCMIN + (DCMAX-DCMIN)*x/DCSTEPS, 1 )
+            forward.append(round( DCMIN + (DCMAX-DCMIN)*curve(CURVE, x/DCSTEPS) ))
+
+        # no reverse if the limit is below crawl speed ( trams )
+        reverse = [0]
+        if DCMAXR >= DCMINR:
+            reverse.append(DCMINR)
+            for x in range(1,DCSTEPS+1):
+                reverse.append(round( DCMINR + (DCMAXR-DCMINR)*curve(CURVER, x/DCSTEPS) ))
+
+        dcramp = tuple([-r for r in reversed(reverse[1:])] + forward)
+        rampzero = len(reverse) - 1
+        ccmin = -rampzero
+        ccmax = DCSTEPS + 1
 
     print("DCSTEPS",DCSTEPS,dcramp)    
 
+def crc16(data, start, end):
+    """
+    CRC-16/CCITT of data[start:end] for the stored profile
+
+    Args:
+        data (bytes): block read from or written to hub storage
+        start (int): first byte
+        end (int): byte after the last
+    """
+    crc = 0xFFFF
+    for i in range(start, end):
+        crc ^= data[i] << 8
+        for _ in range(8):
+            if crc & 0x8000:
+                crc = ((crc << 1) ^ 0x1021) & 0xFFFF
+            else:
+                crc = (crc << 1) & 0xFFFF
+    return crc
+
+def settings():
+    """
+    User defined values the stored ramp table was built from - in CONFIG_FORMAT order after DCMIN and DCMINR
+    """
+    channel = -1 if BROADCASTCHANNEL is None else BROADCASTCHANNEL
+    return (DCMAX, DCMAXR, DCSTEPS, dirmotorA, dirmotorB, channel,
+            CURVES.index(CURVE), CURVES.index(CURVER))
+
+def saveconfig():
+    """
+    Stores the tuned profile in hub storage as one versioned binary block:
+    magic, version, payload length, payload ( CONFIG_FORMAT fields then the ramp table ), CRC-16
+    """
+    payload = ustruct.pack(CONFIG_FORMAT, DCMIN, DCMINR, *settings(), rampzero)
+    payload += ustruct.pack("<B%db" % len(dcramp), len(dcramp), *dcramp)
+    block = CONFIG_MAGIC + ustruct.pack("<BB", CONFIG_VERSION, len(payload)) + payload
+    block += ustruct.pack("<H", crc16(block, 2, len(block)))
+    hub.system.storage(offset=0, write=block)
+
+def loadconfig():
+    """
+    Loads the tuned profile from hub storage with a single read - see saveconfig()
+    The stored DCMIN and DCMINR are used if they are in range. The stored ramp table is only used
+    if they are and the other user defined values still match the script, otherwise it is rebuilt
+    Falls back to the script values if the block is missing, corrupt or from another version
+
+    Returns:
+        bool: True if the stored ramp table is in use and dcprofile() isn't needed
+    """
+    global DCMIN, DCMINR, dcramp, rampzero, ccmin, ccmax
+
+    data = hub.system.storage(offset=0, read=CONFIG_SIZE)
+
+    if data[:2] != CONFIG_MAGIC:
+        # earlier versions only stored b"dc" and 2 digits of DCMIN
+        if data[:2] == b"dc" and (data[2]-48)*10 + data[3]-48 in range(10,41):
+            DCMIN = (data[2]-48)*10 + data[3]-48
+            DCMINR = DCMIN
+            print("Using stored DCMIN",DCMIN," - recalibrate to override",) 
+        else:
+            print("Stored profile not found ( only stored with calibration )")
+            print("Using DCMIN=",DCMIN)
+        return False
+
+    version = data[2]
+    end = 4 + data[3] # end of payload
+    if version not in (1, CONFIG_VERSION) or end + 2 > CONFIG_SIZE:
+        print("Stored profile version",version,"not supported - using DCMIN=",DCMIN)
+        return False
+    if ustruct.unpack_from("<H", data, end)[0] != crc16(data, 2, end):
+        print("Stored profile corrupt - using DCMIN=",DCMIN)
+        return False
+
+    # version 1 had one DCMIN for both directions - its ramp is rebuilt
+    if version == 1:
+        if data[4] in range(10,41):
+            DCMIN = data[4]
+            DCMINR = DCMIN
+            print("Using stored DCMIN",DCMIN," - recalibrate to override",) 
+        else:
+            print("Stored DCMIN",data[4],"out of range - using DCMIN=",DCMIN)
+        return False
+
+    fields = ustruct.unpack_from(CONFIG_FORMAT, data, 4)
+    if fields[0] in range(10,41) and fields[1] in range(10,41):
+        DCMIN = fields[0]
+        DCMINR = fields[1]
+        print("Using stored DCMIN",DCMIN,"reverse",DCMINR," - recalibrate to override",) 
+    else:
+        # the stored ramp was built from them
+        print("Stored DCMIN",fields[0],"reverse",fields[1],"out of range - using DCMIN=",DCMIN,"and the ramp rebuilt")
+        return False
+
+    if fields[2:-1] != settings():
+        print("Settings changed since the profile was stored - ramp rebuilt")
+        return False
+
+    size = ustruct.calcsize(CONFIG_FORMAT)
+    dcramp = ustruct.unpack_from("<%db" % data[4 + size], data, 5 + size)
+    rampzero = fields[-1]
+    ccmin = -rampzero
+    ccmax = len(dcramp) - 1 - rampzero
+    print("Using stored ramp",dcramp)
+    return True
+
 def getmotors(motor):
     """
     Check ports and auto add DC or Technic motors
@@ -177,7 +687,7 @@ def getmotors(motor):
             id = device.info()["id"]
             print("device",id,"on",x)
 
-            if device.info()["id"] < 3:
+            if id < 3:
                 print("DC motor on",port)
                 motor.append(DCMotor(port,motordirection[x]))
 
@@ -191,37 +701,184 @@ def getmotors(motor):
 
         #print(motor)
 
-async def stop():
+def stop(button=False):
     """
-    Sets the stop LED and a wait period before traction can recommence to prevent overruns
+    Sets the stop LED and a brake lockout before traction can recommence to prevent overruns
+    The lockout is ended by unlock() from controller() - nothing waits here
+    A cutoff() fault stays latched unless it is the stop button
+
+    Args:
+        button(bool): called for the stop button on the remote
     """
-    global remotelight
+    global lockstate, lockout, command
 
-    await wait(0)
+    if lockstate == LOCK_FAULT and not button:
+        return
 
-    remotelight = LED_STOP # remote light handled in broadcast()
-    hub.light.on(LED_STOP)
+    status(LED_STOP, STATE_BRAKE)
+    if command != CMD_ESTOP: command = CMD_STOP
 
     if(OUTPUT): print("brake .. (",BRAKE,"ms )")
-    await wait(BRAKE)
+    lockstate = LOCK_BRAKE
+    lockout = clock.time() + BRAKE
 
-    remotelight = LED_READY # remote light handled in broadcast()
-    hub.light.on(LED_READY)
+def unlock():
+    """
+    Ends the brake or crawl lockout once its time is up - ready to move again after braking
+    A fault lockout stays until the stop button is pressed
+    """
+    global lockstate
+
+    if lockstate == LOCK_FAULT:
+        return
+
+    if lockstate == LOCK_BRAKE:
+        status(LED_READY, STATE_READY)
+
+    lockstate = None
+
+def locked(step):
+    """
+    Checks if a +/- step is held off by a lockout
+    Braking holds off both directions, crawl only holds off speeding up
+    so a reversal always goes through at once
+
+    Args:
+        step(int): 1 for + or -1 for -
+    """
+    if lockstate in (LOCK_BRAKE, LOCK_FAULT):
+        return True
+    if lockstate == LOCK_CRAWL:
+        return cc * step > 0
+    return False
+
+def cutoff(reason):
+    """
+    Cuts the power at once for a stall or overload found by monitor()
+    The fault light stays on and +/- are locked out until the stop button is pressed
+
+    Args:
+        reason(string): what was found - for the console
+    """
+    global cc, lockstate
+
+    for m in motor:
+        if (m): m.brake()
+    cc = 0
+    emergency(True) # ems() and the followers stop too
+    status(LED_FAULT, STATE_FAULT)
+    lockstate = LOCK_FAULT
+    if TRACE: trace(TASK_MONITOR)
+    print("fault:",reason,"- power cut, press stop to carry on")
+
+async def monitor():
+    """
+    Watches for a stalled or overloaded train every MONITORRATE ms while there is power:
+    hub current above OVERCURRENT for FAULTTIME ms, or Technic motors not turning
+    for STALLTIME ms. Only cheap reads here, so the drive loop keeps its timing
+    """
+    await wait(0)
 
-    # stop button also used for crawl speed calibration
-    count = 0 
-    while Button.LEFT in remote.buttons.pressed():
-        count += 1
-        if count == 5:
-            print("calibrate DCMIN")
-            await calibrate()
-        await wait(100)
+    encoders = [m for m in motor if m and isinstance(m, Motor)]
+    over = 0 # ms the current has been too high
+    still = 0 # ms the motors haven't turned
+
+    while True:
+        if dc and lockstate != LOCK_FAULT:
+            amps = hub.battery.current()
+            over = over + MONITORRATE if amps > OVERCURRENT else 0
+            fastest = 0
+            for m in encoders: fastest = max(fastest, abs(m.speed()))
+            if encoders and fastest < STALLSPEED:
+                still += MONITORRATE
+            else:
+                still = 0
+
+            if over >= FAULTTIME:
+                cutoff("overload " + str(amps) + " mA")
+            elif still >= STALLTIME:
+                cutoff("stalled")
+        else:
+            over = 0
+            still = 0
+
+        await wait(MONITORRATE)
+
+async def breakaway(direction):
+    """
+    Raises the dc to the motors in 1% steps every AUTOSTEP ms until the train moves:
+    the encoder speed of a Technic motor, or for DC motors the current falling back
+    from its peak as the motor turns ( a stalled motor draws the most current )
+    The dc is sent straight to the motors - no ramp, speed control or compensation
+
+    Args:
+        direction(int): 1 forward or -1 reverse
+
+    Returns:
+        int: the dc the train started to move at - 0 if it didn't or a button was pressed
+    """
+    encoders = [m for m in motor if m and isinstance(m, Motor)]
+    base = hub.battery.current()
+    peak = 0
+    found = 0
+
+    for vc in range(1, AUTOMAX + 1):
+        # any button press stops the search
+        while events and events[0][0] != EV_PRESS:
+            events.pop(0)
+        if events: break
+
+        for m in motor:
+            if (m): m.dc(vc * direction)
+        await wait(AUTOSTEP)
+
+        if encoders:
+            moving = max(abs(m.speed()) for m in encoders) > AUTOSPEED
+        else:
+            amps = hub.battery.current() - base
+            peak = max(peak, amps)
+            moving = peak > AUTOAMPS and amps < peak * (100 - AUTODROP) // 100
+
+        if moving:
+            found = vc
+            break
+
+    for m in motor:
+        if (m): m.stop()
+    await wait(AUTOSETTLE) # let the train roll to a stop
+    return found
+
+async def autocalibrate():
+    """
+    Finds the crawl speed in both directions with breakaway()
+    The dc found plus AUTOMARGIN becomes DCMIN and DCMINR, taken back to VNOMINAL
+    so the battery compensation in power() gets the same result later
+
+    Returns:
+        tuple: ( DCMIN, DCMINR ) or None if the train never moved forward
+    """
+    found = []
+    for direction in (1, -1):
+        # trams don't go backwards
+        if direction < 0 and DCMAXR < 10:
+            found.append(found[0])
+            break
+        vc = await breakaway(direction)
+        if not vc:
+            if direction > 0: return None
+            vc = found[0] # reverse not found - same as forward
+        else:
+            vc = min(40, max(10, vc * 1000 // vfactor + AUTOMARGIN))
+        print("crawl speed", "forward" if direction > 0 else "reverse", vc)
+        found.append(vc)
+    return tuple(found)
 
 async def calibrate():
     """
     Set the crawl speed DCMIN in programme using left buttons (hold,set,save)
+    or press the right stop button to find it automatically in both directions
     """
-    global DCMIN , cc, remotelight
+    global DCMIN , DCMINR, cc
 
     await wait(0)
 
@@ -230,48 +887,75 @@ async def calibrate():
 
     dcprofile("calibrate")
     
-    remotelight = LED_CALIBRATE # remote light handled in broadcast()
-    hub.light.on(LED_CALIBRATE)
+    status(LED_CALIBRATE, STATE_CALIBRATE)
 
     print("Adjust DCMIN (crawl speed) using Left +/- then save with Left Center")
+    print("or press Right Center to find it automatically - the train moves a little both ways")
+
+    while DCMIN == 0:
+        if not events:
+            await wait(0)
+            continue
 
-    while True and DCMIN == 0:
-        pressed = remote.buttons.pressed()
-        if Button.LEFT_PLUS in pressed:
+        event, button = events.pop(0)
+        if event not in (EV_PRESS, EV_REPEAT):
+            continue
+
+        if button == Button.LEFT_PLUS:
             vc += 1
             cc = vc
-            await drive(vc)
+            power(vc)
 
-        if Button.LEFT_MINUS in pressed:
+        elif button == Button.LEFT_MINUS:
             vc = vc - 1 if vc > 0 else 0 # we don't want negative DCMIN
             cc = vc
-            await drive(vc)
+            power(vc)
 
-        if Button.LEFT in pressed and vc > 0:
-            # set new DCMIN
+        elif button == Button.LEFT and event == EV_PRESS and vc > 0:
+            # set new DCMIN - the same both ways
             DCMIN = cc
-            print("new DCMIN is",DCMIN)
+            DCMINR = cc
+
+        elif button == Button.RIGHT and event == EV_PRESS:
+            vc = 0
+            cc = 0
+            power(0)
+            # breakaway() runs open loop - no use for a DCMIN in % of SPEEDMAX
+            if SPEEDCONTROL and any(isinstance(m, Motor) for m in motor):
+                print("SPEEDCONTROL: adjust DCMIN by hand")
+                continue
+            found = await autocalibrate()
+            if found is None:
+                print("the train didn't move - adjust by hand or try again")
+                status(LED_CALIBRATE, STATE_CALIBRATE)
+            else:
+                DCMIN, DCMINR = found
 
-            # store user DCMIN:
-            hub.system.storage(offset=0, write=b"dc" + f"{DCMIN:02}")
-            print("and saved to hub")
+    # the range of the sanity check - loadconfig() won't take anything else
+    DCMIN = min(40, max(10, DCMIN))
+    DCMINR = min(40, max(10, DCMINR))
+    print("new DCMIN is",DCMIN,"reverse",DCMINR)
 
-            dcprofile("run")
-            cc = 1
-            await go(cc)
-            await drive(DCMIN) # not strictly necessary but displays values
+    dcprofile("run")
 
-        await wait(100)
+    # store user DCMIN and the new ramp:
+    saveconfig()
+    print("and saved to hub")
 
-async def go(cc):
+    cc = 1
+    go(cc)
+    power(DCMIN) # not strictly necessary but displays values
+
+def go(cc):
     """
-    Sets status lights and briefly blocks further +/- presses for t ms
+    Sets status lights and a short crawl lockout so the train pauses on crawl
 
     Args:
         cc(int): Controller click count
     """
-    global remotelight
+    global lockstate, lockout, command
 
+    command = CMD_RUN
     lowcc = abs(cc)
     if lowcc == 1:
         led = LED_CRAWL
@@ -284,106 +968,319 @@ async def go(cc):
     else:
         led = LED_GO4
     
-    remotelight = led # remote light handled in broadcast()
-    hub.light.on(led)
+    status(led, STATE_CRAWL if led == LED_CRAWL else STATE_GO)
 
     if led == LED_CRAWL:
         if(OUTPUT): print("crawl .. (",BRAKE/2,"ms )")
         # pause briefly on Crawl 
-        await wait(BRAKE/2) 
-    
-    await wait(BUTTONDELAY)                 
+        lockstate = LOCK_CRAWL
+        lockout = clock.time() + BRAKE/2
+    else:
+        lockstate = None
+
+def emergency(hard):
+    """
+    Priority stop request for ems() - acted on at the next loop pass instead of the next tick
+
+    Args:
+        hard(bool): brake the motors at once, skipping the inertia ramp
+    """
+    global estop, estopat, command, dirty
+
+    if estop != ESTOP_HARD:
+        estop = ESTOP_HARD if hard else ESTOP_RAMP
+    estopat = clock.time()
+    if hard:
+        # the 2nd hub brakes too
+        command = CMD_ESTOP
+        dirty |= DIRTY_FRAME
 
 async def ems(): 
     """
     Check current dc (dc) versus target dc from controller (cc)
     Energy management system monitors and changes the speed of loco 
+    Ticks every DCTICK ms only while dc is converging on the target, otherwise
+    it sleeps until cc or the ramp changes. A stop request from emergency() cuts the tick short
     """
+    global dc, estop, target, applyat, dirty, overbudget, overbytes
+
     await wait(0)
 
-    while True:
-        await wait(0)
+    lastcc = None # cc and dcramp the target was worked out for
+    lastramp = None
+    lastdrive = None # clock ms of the last drive() - None when idle
 
-        direction = copysign(1,cc)
-        target = round(direction*dcramp[abs(cc)])
+    while True:
+        rush = estop # stop requests are never held back for SYNCLEAD
+        if estop:
+            if estop == ESTOP_HARD:
+                dc = 0
+                dirty |= DIRTY_FRAME
+                for m in motor:
+                    if (m): m.brake()
+            if (OUTPUT): print("emergency stop",estop,"after",clock.time()-estopat,"ms")
+            if TRACE: trace(TASK_EMS)
+            estop = ESTOP_NONE
+
+        # only work out the target when it can have changed
+        if cc != lastcc or dcramp is not lastramp:
+            # SYNCLEAD only holds a change that starts from settled - a change mid ramp
+            # and any stop apply at once, and a repeat during the hold keeps its applyat
+            now = clock.time()
+            if rush or cc == 0 or dc != target:
+                applyat = now
+            elif applyat <= now:
+                applyat = now + SYNCLEAD
+            lastcc = cc
+            lastramp = dcramp
+            target = dcramp[cc + rampzero]
+            dirty |= DIRTY_FRAME
+
+        # the followers get the frame first and start the change at applyat too
+        if clock.time() < applyat:
+            while clock.time() < applyat and cc == lastcc and dcramp is lastramp and not estop:
+                await wait(0)
+            lastdrive = None
+            continue
+
+        if dc == target:
+            # converged - idle until the target changes
+            while cc == lastcc and dcramp is lastramp and not estop:
+                await wait(0)
+            lastdrive = None
+            continue
+
+        # PROFILE checks the tick allocates nothing - a garbage collection could land mid ramp
+        if PROFILE: heap = gc.mem_alloc()
+
+        # drive() integrates the real time since the last update, so late ticks don't change the ramp
+        now = clock.time()
+        dt = DCTICK if lastdrive is None else min(now - lastdrive, DTMAX)
+        lastdrive = now
+
+        #print ("drive",target)
+        drive(target, dt)
+
+        if PROFILE:
+            used = gc.mem_alloc() - heap # less after a collection
+            if used > DRIVEBUDGET:
+                overbudget += 1
+                overbytes = max(overbytes, used)
+
+        # DCTICK only sets how smooth the ramp is - ACCEL / DECEL set how fast
+        tick = now + DCTICK
+        while clock.time() < tick and not estop:
+            await wait(0)
+
+def queue(event, button):
+    """
+    Add a button event for controller() - repeats are merged if one is still waiting
 
-        # x is for system shutdown
-        if not dc in (target, "x"):
-            #print ("drive",target)
-            await drive(target)
-        
-        # DCACC controls accel / decel response
-        # try 20 (200ms) for s=12 , less if s higher 
-        await wait(DCACC * 10)
+    Args:
+        event(int): EV_PRESS, EV_REPEAT, EV_HOLD or EV_RELEASE
+        button(Button): the remote button
+    """
+    if event == EV_REPEAT and (event, button) in events:
+        return
+    if len(events) < EVENTS:
+        events.append((event, button))
 
-async def controller():
+async def buttons():
     """
-    Handles button presses and sets remote and hub status lights
+    Button engine: samples the remote every loop pass and queues edge events
+    PRESS and RELEASE for every button, REPEAT while +/- are held down
+    and a single HOLD once a button has been held for LONGPRESS ms.
+    A sample is only worked through when it differs from the last one or a button is down
     """
-    global cc , beat, dc
+    await wait(0)
+
+    down = {} # button -> [ms pressed, ms of next repeat, hold sent]
+    last = () # last sample worked through
 
-    await wait(0)    
-    
     while True:
+        if not remoteup:
+            await wait(0)
+            continue
+
         try:
             pressed = remote.buttons.pressed()
         except OSError as ex:
-            print (" remote not connected: ",ex)
-            await wait(1000)
-            pressed = {}
+            print ("remote lost:",ex)
+            down.clear() # no repeats or holds from buttons that were down
+            last = ()
+            remotelost()
+            continue
+
+        # nothing down and nothing changed - the common case costs a compare
+        if not down and pressed == last:
+            await wait(0)
+            continue
+        last = pressed
+
+        now = clock.time()
+
+        for button in pressed:
+            state = down.get(button)
+            if state is None:
+                down[button] = [now, now + BUTTONHOLD, False]
+                queue(EV_PRESS, button)
+            else:
+                if button in REPEATING and now >= state[1]:
+                    state[1] = now + BUTTONREPEAT
+                    queue(EV_REPEAT, button)
+                if not state[2] and now - state[0] >= LONGPRESS:
+                    state[2] = True
+                    queue(EV_HOLD, button)
+
+        # one release at a time - no copy of down needed to delete from it
+        while True:
+            for button in down:
+                if button not in pressed: break
+            else:
+                break
+            del down[button]
+            queue(EV_RELEASE, button)
+
+        await wait(0)
+
+def remotelost():
+    """
+    Puts the train in the REMOTELOST safe state when the remote drops out
+    and leaves reconnect() to find the remote again
+    """
+    global remoteup, lostat, cc
 
-        if (len(pressed)):
+    remoteup = False
+    lostat = clock.time()
 
-            beat = 1 # reset heartbeat()
+    if REMOTELOST == "stop":
+        cc = 0
+        stop()
+        emergency(False) # ramp down as for the stop button
+    elif REMOTELOST == "crawl" and cc != 0:
+        cc = 1 if cc > 0 else -1
+        go(cc)
+
+async def reconnect():
+    """
+    Searches for a lost remote in the background. Remote() blocks every task, so
+    it searches only once the ramp has settled, with REMOTERETRY ms in between
+    for the others: REMOTESCAN ms at a time while the train stands still, but
+    only REMOTEPEEK ms while it moves ( "crawl" and "keep" ) so the motors,
+    consist() and the frames stall no longer than about one tick. The remote
+    is found less quickly while moving, and pairing it once found still stalls
+    the hub for a moment. Nothing is set up again: cc, dc and the ramp carry
+    on from the safe state, just as before
+    """
+    global remote, remoteup, remoteshown, dirty
+
+    await wait(0)
+
+    while True:
+        while remoteup:
+            await wait(REMOTEPOLL)
+
+        while not remoteup:
+            if dc == target and not estop:
+                try:
+                    remote = Remote(timeout=REMOTESCAN if dc == 0 else REMOTEPEEK)
+                    remoteup = True
+                except OSError:
+                    pass
+            await wait(REMOTERETRY)
+
+        print("remote back after",clock.time() - lostat,"ms")
+        remoteshown = None # the remote needs the light again
+        dirty |= DIRTY_LIGHT
+
+async def controller():
+    """
+    Handles button events and sets remote and hub status lights
+    """
+    global cc , beat, command, dirty
+
+    await wait(0)    
+
+    lastleft = -DOUBLEPRESS # ms of the last stop press
     
-            if Button.LEFT_PLUS in pressed:
-                cc = cc + 1 if cc < DCSTEPS+1 else DCSTEPS+1
-                if (OUTPUT):print("remote",cc)
-                if cc == 0: await stop()
-                else: await go(cc)
+    while True:
+        # timed brake / crawl lockouts - checked every pass so the remote is never ignored
+        if lockstate is not None and clock.time() >= lockout:
+            unlock()
+
+        if not events:
+            await wait(0)
+            continue
+
+        event, button = events.pop(0)
+        beat = 1 # reset heartbeat()
+
+        if button == Button.LEFT_PLUS and event in (EV_PRESS, EV_REPEAT):
+            if locked(1):
+                if (OUTPUT):print("locked out",cc)
+                continue
+            cc = cc + 1 if cc < ccmax else ccmax
+            if (OUTPUT):print("remote",cc)
+            if cc == 0: stop()
+            else: go(cc)
                 
-            elif Button.LEFT_MINUS in pressed:
-                cc = cc - 1 if cc > -(DCSTEPS+1) else -(DCSTEPS+1)
-                if (OUTPUT):print("remote",cc)
-                if cc == 0: await stop()
-                else: await go(cc)
+        elif button == Button.LEFT_MINUS and event in (EV_PRESS, EV_REPEAT):
+            if locked(-1):
+                if (OUTPUT):print("locked out",cc)
+                continue
+            cc = cc - 1 if cc > ccmin else ccmin
+            if (OUTPUT):print("remote",cc)
+            if cc == 0: stop()
+            else: go(cc)
                    
-            elif Button.LEFT in pressed:
+        elif button == Button.LEFT:
+            if event == EV_PRESS:
+                # stop at once - a quick second press brakes hard
+                now = clock.time()
                 cc = 0
                 if (OUTPUT):print("remote",cc)
-                await stop()
+                stop(True)
+                emergency(now - lastleft < DOUBLEPRESS)
+                lastleft = now
+            elif event == EV_HOLD:
+                # stop button held also used for crawl speed calibration
+                print("calibrate DCMIN")
+                await calibrate()
+
+        elif button == Button.RIGHT:
+            if event == EV_PRESS and TRACE: dump()
+            elif event == EV_HOLD and PROFILE: profile()
                 
-            elif Button.CENTER in pressed:
-                # press once to stop the train AND the programme
-                # hold 2 secs to shutdown hub
+        elif button == Button.CENTER:
+            # press once to stop the train AND the programme
+            # hold to shutdown hub
+            if event == EV_PRESS:
                 cc = 0
                 if (OUTPUT):print("remote center",cc)
-                await stop()
-                count = 0
-                while Button.CENTER in pressed:
-                    pressed = remote.buttons.pressed()
-                    count+=1
-                    if (count == 10): # 1 seconds ( plus brake in stop() )
-                        print("Shutting down hub ...")
-                        await remote.light.on(LED_STOP)
-                        if not BROADCASTCHANNEL is None: 
-                            dc = "x" #shut down the second hub
-                            await wait(1000)
-                        hub.system.shutdown() 
-                    await wait(100)
-                
+                stop()
+                emergency(True)
+
+            elif event == EV_HOLD:
+                print("Shutting down hub ...")
+                await remote.light.on(LED_STOP)
+                if not BROADCASTCHANNEL is None: 
+                    command = CMD_SHUTDOWN #shut down the second hub
+                    dirty |= DIRTY_FRAME
+                    await wait(1000)
+                hub.system.shutdown() 
+
+            elif event == EV_RELEASE:
+                if TRACE: dump()
+                if PROFILE: profile()
                 raise SystemExit("Closing program..")
-    
-        # print(len(pressed) or "listening...")
-        # important - controls sensitivity to repeated and held down button presses
-        # also see go()
-        await wait(50)
+
+        if TRACE: trace(TASK_CONTROLLER)
 
 async def heartbeat():
     """
     Shut down after a INACTIVITY minutes of inactivity
     """
-    global beat, dc
+    global beat, command, dirty
 
     await wait(0)
     
@@ -395,8 +1292,10 @@ async def heartbeat():
         # shutdown after 5 minutes if not running and no remote buttons pressed
         elif beat >= INACTIVITY: 
             print ("no activity for",INACTIVITY,"minutes - shutting down ..")
-            if not BROADCASTCHANNEL is None: dc = "x" #shut down the second hub
-            wait(100)
+            if not BROADCASTCHANNEL is None: 
+                command = CMD_SHUTDOWN #shut down the second hub
+                dirty |= DIRTY_FRAME
+                await wait(1000)
             hub.system.shutdown()
             
         beat += 1
@@ -409,11 +1308,16 @@ async def heartbeat():
 Set up multitasking with conditional broadcasting
 """
 
-tasks = [controller(),
+tasks = [buttons(),
+                controller(),
                 ems(),
                 heartbeat(),
-                broadcast()
+                broadcast(),
+                monitor(),
+                collect(),
+                reconnect()
         ]
+tasknames = ["buttons", "controller", "ems", "heartbeat", "broadcast", "monitor", "collect", "reconnect"] # for PROFILE
 
 async def main():
             await multitask(
@@ -436,6 +1340,7 @@ if not DCMIN in range(10,41):
     _bad = DCMIN
     DCMIN = 25
     print (sm[0],"DCMIN",sm[1],_bad,sm[2],DCMIN,sm[3])
+DCMINR = DCMIN # reverse crawl speed - only different once calibrated automatically
 if not DCMAX in range(41,91): 
     _bad = DCMAX
     DCMAX = 80
@@ -444,14 +1349,90 @@ if not DCMAXR in range(0,91):
     _bad = DCMAXR
     DCMAXR = 70
     print (sm[0],"DCMAXR",sm[1],_bad,sm[2],DCMAXR,sm[3])
-if not DCACC in range(1,81): 
-    _bad = DCACC
-    DCACC = 20
-    print (sm[0],"DCACC",sm[1],_bad,sm[2],DCACC,sm[3])
+if not CURVE in ("linear","soft","scurve"): 
+    _bad = CURVE
+    CURVE = "linear"
+    print (sm[0],"CURVE",sm[1],_bad,sm[2],CURVE,sm[3])
+if not CURVER in ("linear","soft","scurve"): 
+    _bad = CURVER
+    CURVER = "linear"
+    print (sm[0],"CURVER",sm[1],_bad,sm[2],CURVER,sm[3])
+if not ACCEL in range(1,201): 
+    _bad = ACCEL
+    ACCEL = 20
+    print (sm[0],"ACCEL",sm[1],_bad,sm[2],ACCEL,sm[3])
+if not DECEL in range(1,201): 
+    _bad = DECEL
+    DECEL = 40
+    print (sm[0],"DECEL",sm[1],_bad,sm[2],DECEL,sm[3])
+if not SPEEDCONTROL in (True,False): 
+    _bad = SPEEDCONTROL
+    SPEEDCONTROL = False
+    print (sm[0],"SPEEDCONTROL",sm[1],_bad,sm[2],SPEEDCONTROL,sm[3])
+if not SPEEDMAX in range(100,2001): 
+    _bad = SPEEDMAX
+    SPEEDMAX = 1000
+    print (sm[0],"SPEEDMAX",sm[1],_bad,sm[2],SPEEDMAX,sm[3])
+if VNOMINAL and not VNOMINAL in range(5000,9001): 
+    _bad = VNOMINAL
+    VNOMINAL = 0
+    print (sm[0],"VNOMINAL",sm[1],_bad,sm[2],VNOMINAL,sm[3])
+if not JERK in range(0,1001): 
+    _bad = JERK
+    JERK = 0
+    print (sm[0],"JERK",sm[1],_bad,sm[2],JERK,sm[3])
+if not DCTICK in range(10,501): 
+    _bad = DCTICK
+    DCTICK = 50
+    print (sm[0],"DCTICK",sm[1],_bad,sm[2],DCTICK,sm[3])
+if not OVERCURRENT in range(500,3001): 
+    _bad = OVERCURRENT
+    OVERCURRENT = 1500
+    print (sm[0],"OVERCURRENT",sm[1],_bad,sm[2],OVERCURRENT,sm[3])
 if not BRAKE in range(1,2001): 
     _bad = BRAKE
     BRAKE = 600
     print (sm[0],"brake",sm[1],_bad,sm[2],BRAKE,sm[3])
+if not BROADCASTRATE in range(10,1001): 
+    _bad = BROADCASTRATE
+    BROADCASTRATE = 100
+    print (sm[0],"BROADCASTRATE",sm[1],_bad,sm[2],BROADCASTRATE,sm[3])
+if not FOLLOWRAMP in (True,False): 
+    _bad = FOLLOWRAMP
+    FOLLOWRAMP = True
+    print (sm[0],"FOLLOWRAMP",sm[1],_bad,sm[2],FOLLOWRAMP,sm[3])
+if not FOLLOWERS in range(0,9): 
+    _bad = FOLLOWERS
+    FOLLOWERS = 0
+    print (sm[0],"FOLLOWERS",sm[1],_bad,sm[2],FOLLOWERS,sm[3])
+if not SYNCLEAD in range(0,256): 
+    _bad = SYNCLEAD
+    SYNCLEAD = 0
+    print (sm[0],"SYNCLEAD",sm[1],_bad,sm[2],SYNCLEAD,sm[3])
+if not BALANCE in (True,False): 
+    _bad = BALANCE
+    BALANCE = False
+    print (sm[0],"BALANCE",sm[1],_bad,sm[2],BALANCE,sm[3])
+if not PROFILE in range(0,501): 
+    _bad = PROFILE
+    PROFILE = 0
+    print (sm[0],"PROFILE",sm[1],_bad,sm[2],PROFILE,sm[3])
+if not TRACE in range(0,2001): 
+    _bad = TRACE
+    TRACE = 0
+    print (sm[0],"TRACE",sm[1],_bad,sm[2],TRACE,sm[3])
+if not REMOTELOST in ("stop","crawl","keep"): 
+    _bad = REMOTELOST
+    REMOTELOST = "stop"
+    print (sm[0],"REMOTELOST",sm[1],_bad,sm[2],REMOTELOST,sm[3])
+if not BUTTONHOLD in range(100,2001): 
+    _bad = BUTTONHOLD
+    BUTTONHOLD = 350
+    print (sm[0],"BUTTONHOLD",sm[1],_bad,sm[2],BUTTONHOLD,sm[3])
+if not BUTTONREPEAT in range(20,1001): 
+    _bad = BUTTONREPEAT
+    BUTTONREPEAT = 100
+    print (sm[0],"BUTTONREPEAT",sm[1],_bad,sm[2],BUTTONREPEAT,sm[3])
 if not dirmotorA in (1,-1): 
     _bad = dirmotorA
     dirmotorA = 1
@@ -468,10 +1449,127 @@ motordirectionB = Direction.CLOCKWISE if dirmotorB == 1 else Direction.COUNTERCL
 motordirection = (motordirectionA , motordirectionB)
 
 # --- init vars and constants
-BUTTONDELAY = 100 # ms delay between button presses if +/- held down used in function go()
+LONGPRESS = 1000 # ms to hold stop ( calibrate ) or center ( shut down hub ) 
+EV_PRESS = 1 # button events queued by buttons() for controller() and calibrate()
+EV_REPEAT = 2
+EV_HOLD = 3
+EV_RELEASE = 4
+EVENTS = 8 # max queued button events
+events = []
+REPEATING = (Button.LEFT_PLUS, Button.LEFT_MINUS) # buttons that repeat when held
+LOCK_BRAKE = 1 # lockstate after stop() - no traction until lockout
+LOCK_CRAWL = 2 # lockstate after go() to crawl - no speeding up until lockout
+LOCK_FAULT = 3 # lockstate after cutoff() - no traction until the stop button
+lockstate = None
+lockout = 0 # clock ms when the lockout ends
+remoteup = True # remote connected - cleared by remotelost()
+remoteshown = Color.BLUE # light colour the remote shows - None for unknown
+lostat = 0 # clock ms the remote was lost
+REMOTEPOLL = 100 # ms between looks at remoteup by reconnect()
+REMOTESCAN = 1000 # ms of each blocking remote search
+REMOTEPEEK = 50 # ms of each blocking remote search while the train moves
+REMOTERETRY = 500 # ms between remote searches for the other tasks to run
+clock = StopWatch() # shared ms clock for button and lockout timing
+DIRTY_FRAME = 1 # dirty flags - set when the frame or remotelight change, cleared by broadcast()
+DIRTY_LIGHT = 2
+dirty = 0
+FRAME_FORMAT = "<BBbbBBHBB" # broadcast frame: seq, command | state << 4, target, dc, light, load, ms, lead, latency
+RAMP_FORMAT = "<BBbbBBHBBBBBBH" # FOLLOWRAMP frame: FRAME_FORMAT + DCMIN DCMINR ACCEL DECEL JERK
+seq = 0 # sequence number of the last frame sent
+seqat = 0 # clock ms it was sent
+TELEMETRY_FORMAT = "<BBbbHHBHb" # follower report: counter, seq received, dc, applied dc, mV, mA, flags,
+                                # its estimate of clock ms here, skew of the last scheduled change in ms
+TELEMETRY_SIZE = 12
+REPORTPOLL = 20 # ms between looks at the follower reports
+SYNCRATE = 1000 # ms between frames when nothing changes and SYNCLEAD is on
+applyat = 0 # clock ms the present target starts to apply - SYNCLEAD after it was set
+latency = 0 # one way radio latency to the followers in ms - worked out by consist()
+UNIT_JOINED = 1 # report flags - the unit is in the consist
+LOSTTIME = 2000 # ms without a report ( or the last frame ) before a unit counts as lost
+LOAD_UNIT = 20 # mA per step of the load sent for BALANCE - 0 is off
+load = 0 # mean consist load in LOAD_UNIT mA
+CMD_RUN = 0 # command - what the 2nd hub should do
+CMD_STOP = 1
+CMD_ESTOP = 2 # brake at once
+CMD_SHUTDOWN = 3
+command = CMD_RUN
+STATE_READY = 0 # state - what the status light shows
+STATE_BRAKE = 1
+STATE_CRAWL = 2
+STATE_GO = 3
+STATE_CALIBRATE = 4
+STATE_FAULT = 5
+state = STATE_READY
+RETRY = 50 # ms before a failed broadcast() frame or light is retried - doubles up to RETRYMAX
+RETRYMAX = 2000
+DOUBLEPRESS = 400 # ms between two stop presses for a hard stop
+ESTOP_NONE = 0 # estop - priority stop requests from emergency() to ems()
+ESTOP_RAMP = 1 # start the inertia ramp down now
+ESTOP_HARD = 2 # brake the motors now, no ramp
+estop = ESTOP_NONE
+estopat = 0 # clock ms of the last stop request
 cc = 0 # (c)ontroller +/- (c)lick count -s -> 0 -> s
 dc = 0 # active (d)uty (c)ycle load
-dcramp = {}
+target = 0 # dc ems() is driving towards
+light = 0 # light level for the 2nd hub - not used yet
+dcramp = () # target dc for each cc, index cc + rampzero - built by dcprofile()
+rampzero = 0
+ccmin = 0 # cc limits for the ramp
+ccmax = 0
+rest = 0 # part of a drive() step below 1% carried to the next update ( 1/1000 % )
+CURVES = ("linear","soft","scurve") # stored by index
+CONFIG_MAGIC = b"PT" # stored profile block - see saveconfig()
+CONFIG_VERSION = 2
+CONFIG_FORMAT = "<bbbbBbbhBBB" # DCMIN DCMINR DCMAX DCMAXR DCSTEPS dirmotorA dirmotorB channel CURVE CURVER rampzero
+CONFIG_SIZE = 256 # bytes read at start up
+rate = 0 # present acceleration in 1/1000 %/s used by drive() for the JERK limit
+faster = False # drive() was speeding up
+DTMAX = 500 # ms - longest time step drive() integrates in one go
+MONITORRATE = 50 # ms between monitor() samples
+FAULTTIME = 200 # ms above OVERCURRENT before the power is cut
+STALLTIME = 1500 # ms Technic motors may stay still with power on - time to get going
+STALLSPEED = 20 # deg/s below which a Technic motor counts as still
+AUTOSTEP = 250 # ms at each dc step of breakaway() for the train to get going
+AUTOMAX = 50 # highest dc breakaway() tries
+AUTOSPEED = 50 # deg/s of a Technic motor that counts as moving
+AUTOAMPS = 50 # mA a stalled motor must draw before a fall counts
+AUTODROP = 15 # % fall from the peak current that counts as moving
+AUTOSETTLE = 1000 # ms for the train to stop after each direction
+AUTOMARGIN = 2 # % added to the dc the train started at
+vfactor = 1000 # dc multiplier in 1/1000 for the battery voltage - worked out by battery()
+vlimit = 90 # max dc sent to DC motors - lowered by battery() as the cells run down
+VSAMPLE = 2000 # ms between battery samples
+VFILTER = 8 # battery filter - each sample moves the filtered voltage 1/VFILTER of the way
+VFACTORMIN = 800 # vfactor limits - the compensation is never more than this
+VFACTORMAX = 1300
+VDERATE = 85 # % of VNOMINAL below which vlimit is lowered
+TRACE_FORMAT = "<IbbbHB" # trace record: clock ms, cc, target, dc, mV, task
+TRACE_SIZE = 10
+TRACE_HEADER = "<4sBBH" # dump() frame header: magic, version, record size, record count
+TRACE_MAGIC = b"PTTR"
+TRACE_VERSION = 1
+TASK_DRIVE = 1 # trace record writers
+TASK_EMS = 2
+TASK_CONTROLLER = 3
+TASK_BROADCAST = 4
+TASK_BATTERY = 5
+TASK_MONITOR = 6
+tracebuf = bytearray(TRACE * TRACE_SIZE) # allocated once - TRACE records
+tracepos = 0 # records written since start up
+DRIVEBUDGET = 0 # bytes an ems() drive tick may allocate - checked with PROFILE
+overbudget = 0 # drive ticks over DRIVEBUDGET
+overbytes = 0 # most bytes allocated by one tick
+GCIDLE = 5000 # ms between garbage collections while the train is stationary
+GCPOLL = 500 # ms between looks at the train for collect()
+GCLOW = 2048 # bytes of free heap below which collect() warns
+heaplow = 1 << 30 # lowest free heap seen by collect()
+collections = 0 # collections made by collect()
+running = None # Profile of the task multitask() is running - PROFILE only
+profiled = 0 # clock ms PROFILE started
+passes = 0 # multitask() loop passes seen by PROFILE
+passstart = 0 # clock ms the present loop pass started
+passend = 0 # clock ms the last resume ended
+passrun = bytearray(PROFILE * 2) # ms each loop pass ran - PROFILE only
 beat = 0 # heartbeat counter
 LED_GO1 = Color.GREEN*0.2  
 LED_GO2 = Color.GREEN*0.3  
@@ -481,9 +1579,19 @@ LED_CRAWL = Color.CYAN*0.3  # crawl ( DCMIN )
 LED_STOP = Color.RED*0.5  # brake 
 LED_READY = Color.ORANGE*1.0  # loco ready and idling
 LED_CALIBRATE = Color.VIOLET # calibrate crawl speed in programme
+LED_FAULT = Color.MAGENTA # stalled or overloaded - power cut
 
 # --- set up hub
-hub = ThisHub(broadcast_channel=BROADCASTCHANNEL)
+if BROADCASTCHANNEL is None: FOLLOWERS = 0
+hub = ThisHub(broadcast_channel=BROADCASTCHANNEL,
+              observe_channels=[BROADCASTCHANNEL + 1 + i for i in range(FOLLOWERS)])
+if FOLLOWERS: # telemetry from the followers
+    tasks.append(consist())
+    tasknames.append("consist")
+mv = hub.battery.voltage() # battery mV - filtered by battery()
+if VNOMINAL or TRACE: # battery compensation, the voltage for TRACE
+    tasks.append(battery())
+    tasknames.append("battery")
 
 # --- clear terminal 
 print("\x1b[H\x1b[2J", end="")
@@ -491,31 +1599,37 @@ print("Pytrain - Asynchronous Train Controller")
 print(hub.system.name())
 print("---\nCell voltage:",round(hub.battery.voltage()/6000,2))
 
+# --- set up everything on the hub first - done by the time the remote is switched on
+# Remote() blocks, so nothing else can run while it searches
+# check for a stored profile ( DCMIN and ramp )
+stored = loadconfig()
+
+# some of these set up functions have to be run before main()
+if not stored: dcprofile("run")
+getmotors(motor)
+
 # --- set up remote 
 print ("Looking for remote ..")
+searched = clock.time()
 try:
     remote = Remote(timeout=20000)
     remotelight = LED_READY # remote light handled in broadcast()
+    dirty |= DIRTY_LIGHT | DIRTY_FRAME
 except OSError as ex:
     print ("Not found - shutting down ..")
     wait(1000)
     hub.system.shutdown()
 
-# check for storage DCMIN
-# read user data:
-data = hub.system.storage(offset=0, read=4)
-data = str(data,"utf-8") 
+hub.light.on(LED_READY)
+print("ready in",clock.time(),"ms - hub set up in",searched,"ms, remote found in",clock.time()-searched,"ms")
 
-if data[:2] == "dc" and int(data[2:4]) in range (0,30): 
-    DCMIN = int(data[2:4])
-    print("Using stored DCMIN",DCMIN," - recalibrate to override",) 
-else:
-    print("Stored DCMIN not found:",data," ( only stored with calibration )")
-    print("Using DCMIN=",DCMIN)
+gc.collect() # start with the set up garbage gone
 
-# some of these set up functions have to be run before main()
-dcprofile("run")
-getmotors(motor)
-hub.light.on(LED_READY)
+if PROFILE:
+    # every task runs inside a Profile and waits through profwait()
+    tasks = [Profile(n, t) for n, t in zip(tasknames, tasks)]
+    taskwait = wait
+    wait = profwait
+    profiled = clock.time()
 
 run_task(main())
\ No newline at end of file
@@ -67,7 +67,7 @@ def getmotors(motor):
             id = device.info()["id"]
             print("device",id,"on",x)
 
-            if device.info()["id"] < 3:
+            if id < 3:
                 print("DC motor on",port)
                 motor.append(DCMotor(port,motordirection[x]))
 
@@ -12,7 +12,14 @@
 # --- User defined values
 # ----------
 
-OBSERVECHANNEL = 1      # Must match Broadcast channel in pytrain.py
+OBSERVECHANNEL = 1      # Must match Broadcast channel in pytrain.py - every hub of a consist uses the same one
+UNIT = 1                # number of this hub in the consist - reports back on channel OBSERVECHANNEL + UNIT ( range 1 - 8, 0 for no reports )
+DIRECTION = 1           # 1 or -1 for a loco coupled the other way round in the consist
+SCALE = 100             # % of the leader's power for this loco ( range 50 - 150 )
+OFFSET = 0              # % added to any power - for a loco that needs more to start ( range -20 - 20 )
+SPEEDCONTROL = False    # Technic ( encoder ) motors hold the speed against grades and load - set as on the leader
+SPEEDMAX = 1000         # motor speed in deg/s at 100% for SPEEDCONTROL - match the leader ( range 100 - 2000 )
+VNOMINAL = 0            # battery mV for compensation as in pytrain.py - 0 for off ( range 5000 - 9000, try 7200 )
 dirmotorA = -1          # A Direction clockwise 1 or -1
 dirmotorB = 1           # B Direction clockwise 1 or -1
 INACTIVITY = 5          # shut down the hub after this many minutes
@@ -24,11 +31,12 @@ OUTPUT = False          # set to true to show extra info for debugging
 # ----------
 
 # --- modules
-from pybricks.parameters import Color, Direction, Port
+from pybricks.parameters import Button, Color, Direction, Port
 from pybricks.pupdevices import DCMotor, Motor
 from pybricks.iodevices import PUPDevice
-from pybricks.tools import multitask, run_task, wait
+from pybricks.tools import multitask, run_task, wait, StopWatch
 from pybricks.hubs import ThisHub
+import ustruct
 
 # ----------
 # --- functions
@@ -48,7 +56,7 @@ async def heartbeat():
         # shutdown after 5 minutes if not running and no remote buttons pressed
         elif beat >= INACTIVITY: 
             print ("no activity for",INACTIVITY,"minutes - shutting down ..")
-            wait(100)
+            await wait(100)
             hub.system.shutdown()
             
         beat += 1
@@ -69,7 +77,7 @@ def getmotors(motor):
             id = device.info()['id']
             print("device",id,"on",x)
 
-            if device.info()['id'] < 3:
+            if id < 3:
                 print("DC motor on",port)
                 motor.append(DCMotor(port,motordirection[x]))
 
@@ -83,71 +91,269 @@ def getmotors(motor):
 
         #print(motor)
 
-# --- drive()
-async def drive():
-    global dc , beat
+# --- drive() - same inertia model as drive() in pytrain.py, run here towards the leader's target
+def drive(dt):
+    global dc, rate, faster, rest
+
+    dckick = ((DCMIN if (dc or target) > 0 else DCMINR) + 1) // 2 # kickstart and kickstop
+
+    # speeding up is moving away from 0 in the direction of the target
+    up = abs(target) > abs(dc) and target * dc >= 0
+    limit = (ACCEL if up else DECEL) * 1000 # in 1/1000 % per second
+
+    if JERK:
+        if up != faster: rate = 0
+        rate = min(limit, rate + JERK * dt)
+    else:
+        rate = limit
+    faster = up
+
+    step = rate * dt // 1000 + rest # in 1/1000 %
+    rest = step % 1000
+    step = step // 1000
+
+    if up and dc == 0:
+        newdc = max(dckick, step)
+        if target < 0: newdc = -newdc
+    elif abs(target - dc) <= step:
+        newdc = target
+    else:
+        newdc = dc + step if target > dc else dc - step
+        # stop at 0 before reversing
+        if not up and (newdc * dc < 0 or abs(newdc) < dckick):
+            newdc = 0
+
+    if newdc == target: 
+        rate = 0
+        rest = 0
+
+    if newdc != dc:
+        dc = newdc
+        power()
+
+# --- ems() - ticks drive() while the leader sends targets and dc hasn't caught up
+# a change starts at startat, the moment the leader starts it too
+async def ems():
+    global skew
 
     await wait(0)
-    
-    currentdc = 0
+
+    lastdrive = None # clock ms of the last drive() - None when idle
 
     while True:
-        # send drive command to motors 1 and 2
-        if currentdc != dc:
+        now = clock.time()
+        if not ramping or dc == target or now < startat:
+            lastdrive = None
+            await wait(1 if 0 < startat - now <= 10 else 10)
+            continue
+
+        if lastdrive is None and startat: skew = max(-128, min(127, now - startat))
+        dt = DCTICK if lastdrive is None else min(now - lastdrive, DTMAX)
+        lastdrive = now
+        drive(dt)
+
+        await wait(DCTICK)
+
+# --- power() - send dc to the motors, adjusted for this loco
+def power():
+    global beat, applied
+
+    speed = abs(dc) * (SCALE + trim) // 100
+    if speed: speed = min(90, max(0, speed + OFFSET)) # a negative OFFSET never reverses
+    out = min(speed * vfactor // 1000, vlimit) # battery compensation from battery() - open loop only
+    if dc * DIRECTION < 0:
+        out = -out
+        speed = -speed
+    applied = out
+
+    # send drive command to motors 1 and 2
+    for m in motor:
+        if not m: continue
+        # in % of SPEEDMAX as on the leader - the motor's own control loop holds the speed
+        if SPEEDCONTROL and isinstance(m, Motor):
+            if speed: m.run(speed * SPEEDMAX // 100)
+            else: m.stop()
+            applied = speed
+        else:
+            m.dc(out)
 
-            for m in motor:
-                if (m): m.dc(dc)
- 
-            if dc: 
-                hub.light.on(LED_GO4)
-            else:
-                hub.light.on(LED_READY)
+    if (OUTPUT): print (dc, out)
 
-            if (OUTPUT): print (dc)
+    beat = 0
 
-            currentdc = dc
-            beat = 0
-                
-        await wait(10)
+# --- brake() - e-stop from the leader, no ramp
+def brake():
+    global dc, applied, beat
 
-# --- listen()
+    dc = 0
+    applied = 0
+    for m in motor:
+        if (m): m.brake()
+
+    if (OUTPUT): print ("emergency stop")
+
+    beat = 0
+
+# --- listen() - frames from pytrain.py broadcast(): seq, command | state << 4, target, dc, light
+# and for FOLLOWRAMP the leader's DCMIN, DCMINR, ACCEL, DECEL and JERK
 async def listen():
-    global dc, light
+    global dc, target, light, load, seq, ramping, startat, offset, DCMIN, DCMINR, ACCEL, DECEL, JERK
 
     await wait(0)
 
+    mode = None # leader state shown on the hub light
+    stale = 0 # passes an older frame has stayed on the air
+
     while True:
 
         try:
             data = hub.ble.observe(OBSERVECHANNEL)
         except Exception as ex:
             print("Unknown problem observing:",ex)
+            data = None
 
-        if data is None:
-            #hub.light.on(LEDnotreceiving)
-            #print('received nothing')
+        if not joined or data is None or len(data) not in (FRAME_SIZE, RAMP_SIZE):
+            # leader gone or restarted, or out of the consist - accept any sequence number next time
+            seq = None
+        # the same frame is seen again on every pass until the leader sends a new one
+        elif data[0] == seq:
             pass
+        # an older frame that stays on the air means the leader restarted
+        elif seq is not None and (data[0] - seq) & 0xFF >= 128 and stale < RESYNC:
+            stale += 1
         else:
-            dc, light = data
-
-            if dc == "x":
+            stale = 0
+            catchup = seq is None
+            ramping = len(data) == RAMP_SIZE
+            if ramping:
+                seq, command, target, newdc, light, load, stamp, lead, latency, DCMIN, DCMINR, ACCEL, DECEL, JERK = ustruct.unpack(RAMP_FORMAT, data)
+            else:
+                seq, command, target, newdc, light, load, stamp, lead, latency = ustruct.unpack(FRAME_FORMAT, data)
+
+            # leader clock - here: the largest difference seen is the one with the least delay,
+            # it sinks slowly so drift between the hub clocks is followed
+            now = clock.time()
+            sample = ((stamp - now + 0x8000) & 0xFFFF) - 0x8000
+            offset = sample if offset is None or sample > offset else offset - 1
+            # the leader starts the change lead ms after stamp - sample - offset is this frame's extra delay
+            startat = now + lead + sample - offset - latency if lead else 0
+            if (OUTPUT): print("frame",seq,"leader clock offset",offset + latency,"ms - start in",startat - now if lead else 0,"ms")
+
+            if command & 0x0F == CMD_SHUTDOWN:
                 hub.system.shutdown()
 
-            elif dc not in range (-100,101):
-                dc = 0
+            elif command & 0x0F == CMD_ESTOP:
+                if dc: brake()
+
+            # ramping here - only take the leader's dc to catch up after joining
+            elif newdc != dc and (catchup or not ramping):
+                dc = max(-100, min(100, newdc))
+                power()
 
-            if light not in range (0,101):
-                light = 0
+            if catchup or command >> 4 != mode:
+                mode = command >> 4
+                hub.light.on(LEDS[mode] if mode < len(LEDS) else LED_READY)
 
         await wait(10)
 
+# --- broadcast() - report to the leader every TELEMETRYRATE ms and trim the power for BALANCE
+async def broadcast():
+    global trim
+
+    await wait(0)
+
+    count = 0
+
+    while True:
+        current = hub.battery.current()
+
+        # load from the leader is the mean of the consist - 0 when BALANCE is off
+        if not load or not dc or not joined:
+            trim = 0
+        else:
+            own = current // LOAD_UNIT
+            change = 1 if own < load * 9 // 10 else -1 if own > load * 11 // 10 else 0
+            if change and abs(trim + change) <= TRIMMAX:
+                trim += change
+                power()
+
+        count = (count + 1) & 0xFF
+        # leader clock as estimated here, for the leader to work out the round trip
+        leadertime = (clock.time() + (offset or 0)) & 0xFFFF
+        report = ustruct.pack(TELEMETRY_FORMAT, count, seq or 0, dc, applied,
+                              hub.battery.voltage(), current, UNIT_JOINED if joined else 0, leadertime, skew)
+        try:
+            await hub.ble.broadcast(report)
+        except OSError as ex:
+            if (OUTPUT): print("report not sent",ex)
+
+        await wait(TELEMETRYRATE)
+
+# --- battery() - compensation for the voltage of this hub's battery as in pytrain.py
+async def battery():
+    global vfactor, vlimit
+
+    await wait(0)
+
+    vlow = VNOMINAL * VDERATE // 100
+    mv = hub.battery.voltage()
+
+    while True:
+        mv += (hub.battery.voltage() - mv) // VFILTER
+
+        factor = max(VFACTORMIN, min(VFACTORMAX, VNOMINAL * 1000 // mv))
+        limit = 100 if mv >= vlow else max(20, 100 * mv // vlow)
+
+        if factor != vfactor or limit != vlimit:
+            vfactor = factor
+            vlimit = limit
+            if (OUTPUT): print("battery",mv,"mV - dc x",vfactor/1000,"max",vlimit)
+            if dc: power()
+
+        await wait(VSAMPLE)
+
+# --- buttons() - hub button: press to leave or join the consist, hold to shut down
+async def buttons():
+    global joined, dc, applied, ramping
+
+    await wait(0)
+
+    while True:
+        while not Button.CENTER in hub.buttons.pressed():
+            await wait(50)
+
+        held = clock.time()
+        while Button.CENTER in hub.buttons.pressed():
+            if clock.time() - held >= LONGPRESS:
+                print("Shutting down hub ...")
+                hub.light.on(LED_STOP)
+                await wait(1000)
+                hub.system.shutdown()
+            await wait(50)
+
+        joined = not joined
+        if joined:
+            # listen() catches up with the leader from its next frame
+            print("joined the consist")
+        else:
+            # coast - the rest of the train keeps going
+            dc = 0
+            applied = 0
+            ramping = False
+            for m in motor:
+                if (m): m.stop()
+            hub.light.on(LED_LEFT)
+            print("left the consist")
+
 # --- main() 
 async def main():
     await multitask(
         listen(),
-        drive(),
+        buttons(),
+        ems(),
         heartbeat(),
-        #broadcast()
+        *([broadcast()] if UNIT else []),
+        *([battery()] if VNOMINAL else [])
     )
 
 # --------------
@@ -159,6 +365,34 @@ async def main():
 # error messages tuple
 sm = ("*** sanity check ***","value","invalid - has been reset to","- check your values")
 
+if not UNIT in range(0,9): 
+    _bad = UNIT
+    UNIT = 1
+    print (sm[0],"UNIT",sm[1],_bad,sm[2],UNIT,sm[3])
+if not DIRECTION in (1,-1): 
+    _bad = DIRECTION
+    DIRECTION = 1
+    print (sm[0],"DIRECTION",sm[1],_bad,sm[2],"integer",DIRECTION,sm[3])
+if not SCALE in range(50,151): 
+    _bad = SCALE
+    SCALE = 100
+    print (sm[0],"SCALE",sm[1],_bad,sm[2],SCALE,sm[3])
+if not OFFSET in range(-20,21): 
+    _bad = OFFSET
+    OFFSET = 0
+    print (sm[0],"OFFSET",sm[1],_bad,sm[2],OFFSET,sm[3])
+if not SPEEDCONTROL in (True,False): 
+    _bad = SPEEDCONTROL
+    SPEEDCONTROL = False
+    print (sm[0],"SPEEDCONTROL",sm[1],_bad,sm[2],SPEEDCONTROL,sm[3])
+if not SPEEDMAX in range(100,2001): 
+    _bad = SPEEDMAX
+    SPEEDMAX = 1000
+    print (sm[0],"SPEEDMAX",sm[1],_bad,sm[2],SPEEDMAX,sm[3])
+if VNOMINAL and not VNOMINAL in range(5000,9001): 
+    _bad = VNOMINAL
+    VNOMINAL = 0
+    print (sm[0],"VNOMINAL",sm[1],_bad,sm[2],VNOMINAL,sm[3])
 if not dirmotorA in (1,-1): 
     _bad = dirmotorA
     dirmotorA = 1
@@ -176,7 +410,51 @@ motordirection = (motordirectionA , motordirectionB)
 
 # --- init vars and constants
 dc = 0 # active (d)uty (c)ycle load
+target = 0 # dc the leader is driving towards
 light = 0 # not used yet 
+FRAME_FORMAT = "<BBbbBBHBB" # must match pytrain.py
+FRAME_SIZE = 10
+RAMP_FORMAT = "<BBbbBBHBBBBBBH" # FRAME_FORMAT + DCMIN DCMINR ACCEL DECEL JERK - must match pytrain.py
+RAMP_SIZE = 16
+TELEMETRY_FORMAT = "<BBbbHHBHb" # report: counter, seq received, dc, applied dc, mV, mA, flags,
+                                # leader clock ms estimated here, skew - must match pytrain.py
+TELEMETRYRATE = 500 # ms between reports
+UNIT_JOINED = 1 # report flags
+LOAD_UNIT = 20 # mA per step of the load from the leader
+TRIMMAX = 20 # % the power can be trimmed up or down for BALANCE
+seq = None # sequence number of the last frame used
+load = 0 # mean consist load from the leader in LOAD_UNIT mA - 0 when BALANCE is off
+trim = 0 # % added to SCALE to share the load
+offset = None # leader clock ms - clock ms here, less the radio latency - None until the first frame
+startat = 0 # clock ms here the present target starts to apply - 0 for at once
+skew = 0 # ms the last scheduled change started late ( - early ) as far as this hub can tell
+applied = 0 # dc sent to the motors by power() - % of SPEEDMAX under SPEEDCONTROL
+vfactor = 1000 # dc multiplier in 1/1000 for the battery voltage - worked out by battery()
+vlimit = 100 # max dc - lowered by battery() as the cells run down
+VSAMPLE = 2000 # ms between battery samples
+VFILTER = 8 # battery filter - each sample moves the filtered voltage 1/VFILTER of the way
+VFACTORMIN = 800 # vfactor limits
+VFACTORMAX = 1300
+VDERATE = 85 # % of VNOMINAL below which vlimit is lowered
+RESYNC = 50 # listen() passes before an older sequence number is taken as a leader restart
+CMD_RUN = 0 # commands from the leader
+CMD_STOP = 1
+CMD_ESTOP = 2
+CMD_SHUTDOWN = 3
+joined = True # False after the hub button took this loco out of the consist
+LONGPRESS = 1000 # ms to hold the hub button to shut down
+ramping = False # the leader sends targets and ems() runs the inertia ramp here
+DCMIN = 25 # leader's ramp parameters - replaced by each RAMP_FORMAT frame
+DCMINR = 25
+ACCEL = 20
+DECEL = 40
+JERK = 0
+DCTICK = 50 # ms between motor updates while ramping
+DTMAX = 500 # ms - longest time step drive() integrates in one go
+rate = 0 # drive() state as in pytrain.py
+faster = False
+rest = 0
+clock = StopWatch()
 beat = 0 # heartbeat counter
 LED_GO1 = Color.GREEN*0.2  
 LED_GO2 = Color.GREEN*0.3  
@@ -186,9 +464,13 @@ LED_CRAWL = Color.CYAN*0.3  # crawl ( dcmin )
 LED_STOP = Color.RED*0.5  # brake 
 LED_READY = Color.ORANGE*1.0  # loco ready and idling
 LED_CALIBRATE = Color.VIOLET # calibrate crawl speed in programme
+LED_LEFT = Color.BLUE*0.3 # out of the consist
+LED_FAULT = Color.MAGENTA # leader found a stall or overload
+LEDS = (LED_READY, LED_STOP, LED_CRAWL, LED_GO4, LED_CALIBRATE, LED_FAULT) # by leader state
 
 # --- find and set up hub - City or Technic
-hub = ThisHub(broadcast_channel=None, observe_channels=[OBSERVECHANNEL])
+hub = ThisHub(broadcast_channel=OBSERVECHANNEL + UNIT if UNIT else None, observe_channels=[OBSERVECHANNEL])
+hub.system.set_stop_button(None) # the hub button is used by buttons()
 
 # --- clear terminal 
 print("\x1b[H\x1b[2J", end="")
@@ -0,0 +1,12 @@
+"""
+PyTrain host simulator
+
+Runs pytrain.py, pytrainfollow.py and pytrain_simple.py unmodified on a host
+computer against stand-in pybricks modules and a virtual clock.
+
+    python -m sim pytrain.py --press 1000:LEFT_PLUS --until 10000
+
+See World in sim/world.py for the Python interface.
+"""
+
+from sim.world import Press, RemotePlan, SimHub, World  # noqa: F401
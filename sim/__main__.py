@@ -0,0 +1,118 @@
+"""
+Command line runner for the PyTrain simulator
+
+Examples:
+    python -m sim pytrain.py --press 1000:LEFT_PLUS --press 1500:LEFT_PLUS --until 8000
+    python -m sim pytrain.py --set BROADCASTCHANNEL=1 --follow pytrainfollow.py --set-follow OBSERVECHANNEL=1
+    python -m sim pytrain.py --set BROADCASTCHANNEL=1 --follow pytrainfollow.py --follow pytrainfollow.py:DIRECTION=-1,SCALE=90
+    python -m sim pytrain_simple.py --press 500:LEFT_PLUS:1200 --trace
+    python -m sim pytrain.py --set TRACE=500 --press 1000:LEFT_PLUS --press 8000:RIGHT --dump trace.bin
+"""
+
+import argparse
+import ast
+import os
+
+from sim.world import Press, RemotePlan, World
+
+
+def press(text):
+    """Parse ms:BUTTON[+BUTTON][:hold] e.g. 1000:LEFT_PLUS or 2000:CENTER:2500"""
+    parts = text.split(":")
+    hold = int(parts[2]) if len(parts) > 2 else 100
+    return Press(int(parts[0]), *parts[1].upper().split("+"), hold=hold)
+
+
+def setting(text):
+    """Parse NAME=value where value is a Python literal"""
+    key, _, value = text.partition("=")
+    try:
+        value = ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        pass
+    return key, value
+
+
+def follow(text):
+    """Parse script[:NAME=value,NAME=value] into (script, overrides)"""
+    script, _, values = text.partition(":")
+    return script, dict(setting(v) for v in values.split(",") if v)
+
+
+def button(text):
+    """Parse hub:ms[:hold] e.g. 1:5000 - a press of the own button of hub 1 ( the first follower )"""
+    parts = text.split(":")
+    hold = int(parts[2]) if len(parts) > 2 else 100
+    return int(parts[0]), Press(int(parts[1]), "CENTER", hold=hold)
+
+
+def devices(text):
+    """Parse A=2,B=38 into a port -> device id dict ( empty string for no motors )"""
+    return {k.upper(): int(v) for k, v in (p.split("=") for p in text.split(",") if p)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m sim", description=__doc__.splitlines()[1])
+    parser.add_argument("script", help="script to run on the leading hub")
+    parser.add_argument("--until", type=int, default=10000, help="virtual ms to run for")
+    parser.add_argument("--press", type=press, action="append", default=[],
+                        metavar="MS:BUTTON[:HOLD]", help="remote button press")
+    parser.add_argument("--drop", action="append", default=[], metavar="START:END",
+                        help="remote out of range between START and END ms")
+    parser.add_argument("--remote-at", type=int, default=0, help="ms when the remote is switched on")
+    parser.add_argument("--no-remote", action="store_true", help="never find a remote")
+    parser.add_argument("--set", type=setting, action="append", default=[], metavar="NAME=VALUE",
+                        help="override a user defined value in the script")
+    parser.add_argument("--devices", type=devices, default={"A": 2, "B": 2},
+                        help="port=id list, default A=2,B=2 ( DC train motors )")
+    parser.add_argument("--storage", default="", help="initial hub storage as text")
+    parser.add_argument("--voltage", type=int, default=8400, help="battery mV")
+    parser.add_argument("--follow", type=follow, action="append", default=[],
+                        metavar="SCRIPT[:NAME=VALUE,..]",
+                        help="script to run on a following hub - repeat for more hubs")
+    parser.add_argument("--set-follow", type=setting, action="append", default=[],
+                        metavar="NAME=VALUE", help="override a user defined value in every follower")
+    parser.add_argument("--button", type=button, action="append", default=[], metavar="HUB:MS[:HOLD]",
+                        help="press the hub button of hub HUB ( 0 = leader, 1 = first follower .. )")
+    parser.add_argument("--quiet", action="store_true", help="don't echo script output")
+    parser.add_argument("--trace", action="store_true", help="print every duty cycle change")
+    parser.add_argument("--dump", metavar="FILE",
+                        help="save the binary output of the leading hub ( decode with python -m sim.trace )")
+    args = parser.parse_args(argv)
+
+    remote = None
+    if not args.no_remote:
+        drops = [tuple(int(x) for x in d.split(":")) for d in args.drop]
+        remote = RemotePlan(connect=args.remote_at, presses=args.press, drops=drops)
+
+    with World(echo=not args.quiet, strict=False) as world:
+        buttons = [[p for n, p in args.button if n == i] for i in range(len(args.follow) + 1)]
+        hubs = [world.add_hub(args.script, remote=remote, devices=args.devices,
+                              overrides=dict(args.set), storage=args.storage.encode(),
+                              voltage=args.voltage, buttons=buttons[0])]
+        for i, (script, overrides) in enumerate(args.follow, 1):
+            name = "%s.%d" % (os.path.splitext(os.path.basename(script))[0], i)
+            hubs.append(world.add_hub(script, name=name, devices=args.devices,
+                                      overrides=dict(args.set_follow, **overrides),
+                                      voltage=args.voltage, buttons=buttons[i]))
+        world.run(until=args.until)
+
+        print("--- simulation ended at %d ms" % world.now)
+        for hub in hubs:
+            print("%s: exit=%s adverts=%d" % (hub.name, hub.exit, hub.adverts))
+            for port, motor in sorted(hub.motors.items()):
+                print("  motor %s: %d changes, last dc %s" % (port, len(motor.history) - 1, hub.dc(port)))
+                if args.trace:
+                    for t, dc in motor.history:
+                        print("    %8d %s" % (t, dc))
+            if hub.error is not None:
+                print("  error: %r" % hub.error)
+
+        if args.dump:
+            with open(args.dump, "wb") as f:
+                f.write(hubs[0].binary)
+            print("%d bytes of binary output saved to %s" % (len(hubs[0].binary), args.dump))
+
+
+if __name__ == "__main__":
+    main()
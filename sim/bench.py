@@ -0,0 +1,201 @@
+"""
+Button-to-motor latency benchmarks for pytrain.py
+
+Injects remote presses into the simulator and times each stage between the
+button going down and the motors receiving the new duty cycle:
+
+    seen    press -> controller() reacts ( hub status light changes )
+    motor   press -> first m.dc() with the new duty cycle
+    target  press -> last m.dc() of the ramp ( dc settled )
+
+for a start from stationary, a stop press and a hard stop ( double stop press ).
+
+All times are virtual ms. wall is the host time spent simulating from the
+press to the first m.dc(), a rough measure of interpreter work on the path.
+
+    python -m sim.bench                     # print the tables
+    python -m sim.bench --json out.json     # also save the results
+    python -m sim.bench --check sim/bench_baseline.json   # exit 1 on a regression
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+from sim.world import Press, RemotePlan, World
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPT = os.path.join(ROOT, "pytrain.py")
+START = 2000        # ms - well after start up has finished
+SETTLE = 15000      # ms allowed for a ramp to finish
+STEPS = (5, 12, 25, 50, 100)
+ACCELS = (5, 10, 20, 50, 100)   # ACCEL %/s, DECEL is twice that
+TICK = 50           # DCTICK the phases are swept over
+CASES = ("start", "stop", "estop")
+TOLERANCE = 0.10    # allowed relative slow down before --check fails
+SLACK = 20          # ms always allowed on top of TOLERANCE
+
+
+def measure(press, before=(), overrides=None, script=SCRIPT, settle=SETTLE):
+    """
+    Run one scenario and time the response to press
+
+    Args:
+        press (Press): the press to time
+        before (list): presses to get the train into the wanted state first
+        overrides (dict): user defined values for the script
+        script (str): script to run
+
+    Returns:
+        dict: seen, motor, target ( virtual ms after press.at - None if it never happened ),
+              dc ( settled duty cycle ), wall ( host ms from press to first m.dc() )
+    """
+    remote = RemotePlan(presses=list(before) + [press])
+    with World() as world:
+        loco = world.add_hub(script, remote=remote, overrides=overrides)
+        world.run(until=press.at - 1)
+        motor = loco.motors["A"]
+        lights = len(loco.lights)
+        changes = len(motor.history)
+        wall = time.perf_counter()
+        result = {"seen": None, "motor": None, "target": None, "dc": loco.dc(), "wall": None}
+        end = press.at + settle
+        while world.now < end and not loco.done:
+            world.run(until=world.now + 1)
+            if result["seen"] is None and len(loco.lights) > lights:
+                result["seen"] = loco.lights[lights][0] - press.at
+            if result["motor"] is None and len(motor.history) > changes:
+                result["motor"] = motor.history[changes][0] - press.at
+                result["wall"] = round((time.perf_counter() - wall) * 1000, 3)
+        if len(motor.history) > changes:
+            result["target"] = motor.history[-1][0] - press.at
+            result["dc"] = motor.history[-1][1]
+    return result
+
+
+def phases(step=7):
+    """Press offsets covering one ems() tick"""
+    return range(0, TICK + step, step)
+
+
+def rates(accel):
+    """Overrides for an ACCEL of accel %/s"""
+    return {"ACCEL": accel, "DECEL": 2 * accel, "DCTICK": TICK}
+
+
+def stage_stats(results, key):
+    values = [r[key] for r in results if r[key] is not None]
+    if not values:
+        return {"min": None, "mean": None, "max": None}
+    return {"min": min(values), "mean": round(sum(values) / len(values), 1), "max": max(values)}
+
+
+def bench_start(overrides=None):
+    """Stationary -> crawl: one LEFT_PLUS press at every phase of the ems() tick"""
+    runs = [measure(Press(START + p, "LEFT_PLUS"), overrides=overrides) for p in phases()]
+    return {k: stage_stats(runs, k) for k in ("seen", "motor", "target", "wall")}
+
+
+def bench_stop(overrides=None):
+    """Running at step 3 -> stop: one LEFT press at every phase of the ems() tick"""
+    before = [Press(START, "LEFT_PLUS"), Press(START + 800, "LEFT_PLUS"), Press(START + 1200, "LEFT_PLUS")]
+    at = START + 8000
+    runs = [measure(Press(at + p, "LEFT"), before, overrides) for p in phases()]
+    return {k: stage_stats(runs, k) for k in ("seen", "motor", "target", "wall")}
+
+
+def bench_estop(overrides=None):
+    """Running at step 3 -> hard stop: a second short LEFT press 50 ms after the first"""
+    before = [Press(START, "LEFT_PLUS"), Press(START + 800, "LEFT_PLUS"), Press(START + 1200, "LEFT_PLUS")]
+    at = START + 8000
+    runs = [measure(Press(at + p + 50, "LEFT", hold=30), before + [Press(at + p, "LEFT", hold=30)], overrides)
+            for p in phases()]
+    return {k: stage_stats(runs, k) for k in ("seen", "motor", "target", "wall")}
+
+
+def bench_full(steps, accel):
+    """Hold LEFT_PLUS from stationary until full speed - time to the settled max dc"""
+    overrides = dict(rates(accel), DCSTEPS=steps)
+    hold = (steps + 2) * 300 + 1000
+    result = measure(Press(START, "LEFT_PLUS", hold=hold), overrides=overrides, settle=hold + SETTLE)
+    return {"target": result["target"], "dc": result["dc"]}
+
+
+def run(quick=False):
+    """Run every benchmark and return the results as a dict"""
+    steps = (5, 12, 100) if quick else STEPS
+    accels = (5, 20, 100) if quick else ACCELS
+    results = {"start": {}, "stop": {}, "estop": {}, "full": {}}
+    for accel in accels:
+        results["start"]["ACCEL=%d" % accel] = bench_start(rates(accel))
+        results["stop"]["ACCEL=%d" % accel] = bench_stop(rates(accel))
+        results["estop"]["ACCEL=%d" % accel] = bench_estop(rates(accel))
+    for s in steps:
+        for accel in accels:
+            results["full"]["DCSTEPS=%d ACCEL=%d" % (s, accel)] = bench_full(s, accel)
+    return results
+
+
+def report(results, out=sys.stdout):
+    for name in CASES:
+        if name not in results:
+            continue
+        out.write("\n%s latency (ms after press: min / mean / max)\n" % name)
+        out.write("%-12s %-20s %-20s %-20s %s\n" % ("", "seen", "motor", "target", "wall"))
+        for case, stages in results[name].items():
+            cells = ["%s / %s / %s" % (s["min"], s["mean"], s["max"])
+                     for s in (stages[k] for k in ("seen", "motor", "target", "wall"))]
+            out.write("%-12s %-20s %-20s %-20s %s\n" % (case, *cells))
+    out.write("\ntime to full speed with + held (ms after press)\n")
+    for case, r in results["full"].items():
+        out.write("%-22s %8s ms  dc %s\n" % (case, r["target"], r["dc"]))
+
+
+def regressions(results, baseline):
+    """List of 'case stage: now > was' for every virtual time that got worse"""
+    found = []
+    for name in CASES:
+        for case, stages in baseline.get(name, {}).items():
+            if case not in results.get(name, {}):
+                continue
+            for stage in ("seen", "motor", "target"):
+                was = stages[stage]["max"]
+                now = results[name].get(case, {}).get(stage, {}).get("max")
+                if was is not None and (now is None or now > was * (1 + TOLERANCE) + SLACK):
+                    found.append("%s %s %s: %s > %s" % (name, case, stage, now, was))
+    for case, r in baseline.get("full", {}).items():
+        if case not in results["full"]:
+            continue
+        was = r["target"]
+        now = results["full"].get(case, {}).get("target")
+        if was is not None and (now is None or now > was * (1 + TOLERANCE) + SLACK):
+            found.append("full %s: %s > %s" % (case, now, was))
+    return found
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m sim.bench", description=__doc__.splitlines()[1])
+    parser.add_argument("--quick", action="store_true", help="smaller DCSTEPS / ACCEL grid")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--check", help="baseline results - exit 1 if any virtual time regressed")
+    args = parser.parse_args(argv)
+
+    results = run(quick=args.quick)
+    report(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=1)
+    if args.check:
+        with open(args.check) as f:
+            found = regressions(results, json.load(f))
+        for line in found:
+            print("REGRESSION", line)
+        if found:
+            sys.exit(1)
+        print("\nno regressions against", args.check)
+
+
+if __name__ == "__main__":
+    main()
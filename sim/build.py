@@ -0,0 +1,559 @@
+"""
+Build a stripped, hub specific copy of a PyTrain script
+
+Takes the user defined values for one locomotive and writes a script with
+them built in - smaller to upload, less RAM and a quicker start:
+
+    * integer constants become MicroPython const() named with a leading _,
+      so they take no RAM on the hub - all put just after the imports, as
+      the hub only puts a const() in where it is used after it
+    * True / False / None constants are put in where they are used and the
+      code they switch off is left out: the OUTPUT prints, features that are
+      not used ( e.g. the broadcast frames with BROADCASTCHANNEL = None ) and
+      the sanity checks of values that are fine
+    * functions, values and imports nothing uses any more, docstrings and
+      comments are dropped
+
+    python -m sim.build pytrain.py --config ice.cfg -o build/ice.py
+    python -m sim.build pytrain.py --set BROADCASTCHANNEL=1 --set FOLLOWERS=2 -o build/lead.py --mpy
+    python -m sim.build pytrain.py --config ice.cfg -o build/ice.py --check
+
+The config file has one NAME = value line per user defined value to change,
+just like the top of the script ( comments are fine ). Values that can still
+change while the script runs ( DCMIN after a calibration .. ) are kept as they
+are. --check runs the original and the build in the simulator and compares
+what the motors and lights do, and checks every const() comes above its first
+use ( the simulator can't tell ), --mpy also compiles the build with mpy-cross.
+Needs Python 3.9+.
+"""
+
+import argparse
+import ast
+import builtins
+import os
+import shutil
+import subprocess
+import sys
+
+PURE_CALLS = ("range", "len", "min", "max", "abs", "tuple", "bytes", "bytearray")  # no side effects
+PURE_NODES = (ast.Constant, ast.Name, ast.Tuple, ast.List, ast.Dict, ast.BinOp, ast.UnaryOp, ast.BoolOp,
+              ast.Compare, ast.IfExp, ast.Call, ast.expr_context, ast.operator, ast.unaryop, ast.boolop,
+              ast.cmpop)
+INDENT = " "        # per block level in the build
+
+
+class BuildError(Exception):
+    """The config doesn't fit the script"""
+
+
+class Unknown(Exception):
+    """An expression that can't be worked out at build time"""
+
+
+def pure(node):
+    """True if evaluating node can't have side effects"""
+    for child in ast.walk(node):
+        if not isinstance(child, PURE_NODES):
+            return False
+        if isinstance(child, ast.Call) and not (isinstance(child.func, ast.Name)
+                                                and child.func.id in PURE_CALLS and not child.keywords):
+            return False
+    return True
+
+
+def evaluate(node, env):
+    """
+    Value of expression node at build time
+
+    Args:
+        node (ast.expr): expression
+        env (dict): name -> value of the names known at build time
+
+    Raises:
+        Unknown: if node uses anything else
+    """
+    if not pure(node):
+        raise Unknown
+    names = {n.id for n in ast.walk(node) if isinstance(n, ast.Name)}
+    if any(n not in env and n not in PURE_CALLS for n in names):
+        raise Unknown
+    calls = {n: getattr(builtins, n) for n in PURE_CALLS}
+    try:
+        return eval(compile(ast.Expression(node), "<build>", "eval"), {"__builtins__": calls}, dict(env))
+    except Exception:
+        raise Unknown
+
+
+def literal(value):
+    """Expression node for a config value"""
+    return ast.parse(repr(value), mode="eval").body
+
+
+def stored(node):
+    """Names bound anywhere in node"""
+    names = set()
+    for child in ast.walk(node):
+        if isinstance(child, ast.Name) and isinstance(child.ctx, (ast.Store, ast.Del)):
+            names.add(child.id)
+        elif isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            names.add(child.name)
+        elif isinstance(child, (ast.Import, ast.ImportFrom)):
+            names.update((a.asname or a.name).split(".")[0] for a in child.names)
+        elif isinstance(child, ast.ExceptHandler) and child.name:
+            names.add(child.name)
+    return names
+
+
+def local_names(func):
+    """Names local to a function ( arguments and stores not declared global )"""
+    args = func.args
+    names = {a.arg for a in args.posonlyargs + args.args + args.kwonlyargs}
+    names.update(a.arg for a in (args.vararg, args.kwarg) if a)
+    glob = set()
+    for stmt in func.body:
+        for child in ast.walk(stmt):
+            if isinstance(child, (ast.Global, ast.Nonlocal)):
+                glob.update(child.names)
+        names |= stored(stmt)
+    return names - glob
+
+
+def apply_config(tree, config):
+    """Put the config values into the first top level assignment of each name"""
+    for name, value in config.items():
+        for stmt in tree.body:
+            if (isinstance(stmt, ast.Assign) and len(stmt.targets) == 1
+                    and isinstance(stmt.targets[0], ast.Name) and stmt.targets[0].id == name):
+                stmt.value = literal(value)
+                break
+        else:
+            raise BuildError("%s is not a user defined value in the script" % name)
+
+
+class Folder(ast.NodeTransformer):
+    """
+    Puts folded constants in, renames const() ones and drops dead branches and docstrings
+
+    Args:
+        folded (dict): name -> value put in where used
+        renamed (dict): name -> _name of the const() values
+        known (dict): name -> value of every constant, for deciding branches
+    """
+    def __init__(self, folded, renamed, known):
+        self.folded = folded
+        self.renamed = renamed
+        self.known = known
+        self.scopes = [set()]
+
+    def visit_Name(self, node):
+        if node.id in self.scopes[-1]:
+            return node
+        if isinstance(node.ctx, ast.Load) and node.id in self.folded:
+            return ast.copy_location(literal(self.folded[node.id]), node)
+        if node.id in self.renamed:
+            node.id = self.renamed[node.id]
+        return node
+
+    def visit_FunctionDef(self, node):
+        self.scopes.append(local_names(node) | self.scopes[-1])
+        self.generic_visit(node)
+        self.scopes.pop()
+        node.body = self.block(node.body)
+        return node
+
+    visit_AsyncFunctionDef = visit_FunctionDef
+
+    def visit_ClassDef(self, node):
+        self.generic_visit(node)
+        node.body = self.block(node.body)
+        return node
+
+    def decide(self, test):
+        """True / False if test is decided at build time, else None"""
+        env = {k: v for k, v in self.known.items() if k not in self.scopes[-1]}
+        if isinstance(test, ast.BoolOp):
+            # a decided operand after pure ones decides the lot
+            for value in test.values:
+                try:
+                    result = bool(evaluate(value, env))
+                except Unknown:
+                    if not pure(value):
+                        return None
+                    continue
+                if result == isinstance(test.op, ast.Or):
+                    return result
+            try:
+                return bool(evaluate(test, env))
+            except Unknown:
+                return None
+        if isinstance(test, ast.UnaryOp) and isinstance(test.op, ast.Not):
+            result = self.decide(test.operand)
+            return None if result is None else not result
+        try:
+            return bool(evaluate(test, env))
+        except Unknown:
+            return None
+
+    def visit_If(self, node):
+        result = self.decide(node.test)
+        if result is None:
+            self.generic_visit(node)
+            node.body = self.block(node.body)
+            node.orelse = [s for s in node.orelse if not docstring(s)]
+            return node
+        branch = node.body if result else node.orelse
+        out = []
+        for stmt in branch:
+            stmt = self.visit(stmt)
+            out.extend(stmt if isinstance(stmt, list) else [stmt] if stmt else [])
+        return out
+
+    def visit_While(self, node):
+        if self.decide(node.test) is False:
+            return node.orelse and [self.visit(s) for s in node.orelse]
+        self.generic_visit(node)
+        node.body = self.block(node.body)
+        return node
+
+    def visit_IfExp(self, node):
+        result = self.decide(node.test)
+        if result is None:
+            return self.generic_visit(node)
+        return self.visit(node.body if result else node.orelse)
+
+    def visit_Expr(self, node):
+        if docstring(node):
+            return None
+        return self.generic_visit(node)
+
+    def block(self, body):
+        """A body that lost all its statements still needs one"""
+        body = [s for s in body if not docstring(s)]
+        return body or [ast.Pass()]
+
+
+def docstring(stmt):
+    return isinstance(stmt, ast.Expr) and isinstance(stmt.value, ast.Constant) and isinstance(stmt.value.value, str)
+
+
+def constants(tree, config):
+    """
+    Work out the top level names with a value known at build time
+
+    Runs through the top level statements in order and decides the top level
+    ifs on the way - a decided if is replaced by its branch. Names declared
+    global anywhere, or bound in any other way, are never constant.
+
+    A name assigned more than once is only constant if it always gets the same value.
+
+    Returns:
+        dict: name -> value of the constants
+    """
+    variable = set()
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.Global, ast.Nonlocal)):
+            variable.update(node.names)
+    env = {}
+    values = {} # name -> every value assigned
+
+    def walk(stmts):
+        out = []
+        for stmt in stmts:
+            if isinstance(stmt, ast.If):
+                try:
+                    result = evaluate(stmt.test, {k: v for k, v in env.items() if k not in variable})
+                except Unknown:
+                    result = None
+                if result is not None:
+                    branch = stmt.body if result else stmt.orelse
+                    reset = stored(ast.Module(body=branch, type_ignores=[])) & set(config)
+                    for name in sorted(reset):
+                        sys.stderr.write("warning: the script resets %s = %r - check the value\n" % (name, config[name]))
+                    out.extend(walk(branch))
+                    continue
+            if (isinstance(stmt, ast.Assign) and len(stmt.targets) == 1
+                    and isinstance(stmt.targets[0], ast.Name)):
+                name = stmt.targets[0].id
+                try:
+                    env[name] = evaluate(stmt.value, {k: v for k, v in env.items() if k not in variable})
+                    values.setdefault(name, []).append(env[name])
+                except Unknown:
+                    variable.add(name)
+            elif not isinstance(stmt, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+                variable.update(stored(stmt))
+            else:
+                variable.add(stmt.name)
+            out.append(stmt)
+        return out
+
+    tree.body = walk(tree.body)
+    return {k: v for k, v in env.items() if k not in variable and type(v) in (int, bool, type(None))
+            and all(type(x) is type(v) and x == v for x in values[k])}
+
+
+def prune(tree):
+    """Drop top level functions, pure values and imports nothing uses - until nothing changes"""
+    while True:
+        # global statements only for names the function still stores
+        for func in ast.walk(tree):
+            if isinstance(func, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                names = set()
+                for stmt in func.body:
+                    names |= stored(stmt)
+                for node in ast.walk(func):
+                    if isinstance(node, ast.Global):
+                        node.names = [n for n in node.names if n in names] or node.names
+        used = {}
+        for stmt in tree.body:
+            defined = stmt.name if isinstance(stmt, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)) else None
+            for node in ast.walk(stmt):
+                name = None
+                if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Load):
+                    name = node.id
+                elif isinstance(node, ast.Global):
+                    for n in node.names:
+                        used[n] = used.get(n, 0) + 1
+                if name and name != defined:
+                    used[name] = used.get(name, 0) + 1
+        body = []
+        for stmt in tree.body:
+            if isinstance(stmt, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)) and stmt.name not in used:
+                continue
+            if (isinstance(stmt, ast.Assign) and len(stmt.targets) == 1 and isinstance(stmt.targets[0], ast.Name)
+                    and stmt.targets[0].id not in used and (pure(stmt.value) or const(stmt.value))):
+                continue
+            if isinstance(stmt, (ast.Import, ast.ImportFrom)):
+                stmt.names = [a for a in stmt.names if (a.asname or a.name).split(".")[0] in used]
+                if not stmt.names:
+                    continue
+            body.append(stmt)
+        if len(body) == len(tree.body):
+            return
+        tree.body = body
+
+
+def const(node):
+    """True if node is a const() of a plain value"""
+    return (isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id == "const"
+            and all(pure(a) for a in node.args))
+
+
+def header(source):
+    """The comment block at the top of the source ( name, version, licence )"""
+    lines = []
+    for line in source.splitlines():
+        if not line.startswith("#"):
+            break
+        lines.append(line.rstrip())
+    return lines
+
+
+def reindent(text):
+    """Shrink the 4 space indents of ast.unparse to INDENT"""
+    out = []
+    for line in text.splitlines():
+        body = line.lstrip(" ")
+        out.append(INDENT * ((len(line) - len(body)) // 4) + body)
+    return "\n".join(out) + "\n"
+
+
+def build(source, config, name="script"):
+    """
+    Build the hub specific script
+
+    Args:
+        source (str): the script
+        config (dict): user defined values to build in
+        name (str): config name for the header
+
+    Returns:
+        str: the built script
+    """
+    tree = ast.parse(source)
+    apply_config(tree, config)
+    known = constants(tree, config)
+
+    everything = {n.id for n in ast.walk(tree) if isinstance(n, ast.Name)}
+    folded = {}
+    renamed = {}
+    for n, v in known.items():
+        if type(v) is int and not n.startswith("_") and "_" + n not in everything:
+            renamed[n] = "_" + n
+        else:
+            folded[n] = v
+
+    tree = Folder(folded, renamed, known).visit(tree)
+    body = []
+    consts = []
+    for stmt in tree.body:
+        if isinstance(stmt, ast.Assign) and len(stmt.targets) == 1 and isinstance(stmt.targets[0], ast.Name):
+            target = stmt.targets[0].id
+            if target in folded:
+                continue
+            if target in renamed.values():
+                if any(s.targets[0].id == target for s in consts):
+                    continue # the same value again - a const() is only set once
+                stmt.value = ast.Call(func=ast.Name(id="const", ctx=ast.Load()),
+                                      args=[literal(known[target[1:]])], keywords=[])
+                consts.append(stmt)
+                continue
+        body.append(stmt)
+    # a const() name is only put in below its definition, and isn't a global either -
+    # so they all go after the imports, above every function
+    imports = 0
+    for i, stmt in enumerate(body):
+        if isinstance(stmt, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            break
+        if isinstance(stmt, (ast.Import, ast.ImportFrom)):
+            imports = i + 1
+    tree.body = body[:imports] + consts + body[imports:]
+    prune(tree)
+
+    # a block that lost all its statements ( e.g. an except with only an OUTPUT print ) needs one
+    for node in ast.walk(tree):
+        if isinstance(getattr(node, "body", None), list) and not node.body:
+            node.body = [ast.Pass()]
+
+    if any(isinstance(n, ast.Name) and n.id == "const" for n in ast.walk(tree)):
+        tree.body.insert(0, ast.ImportFrom(module="micropython", names=[ast.alias(name="const")], level=0))
+    ast.fix_missing_locations(tree)
+
+    lines = header(source)
+    lines.append("#")
+    lines.append("# Built for %s by python -m sim.build - change the source and build again" % name)
+    if config:
+        lines.extend("# %s = %r" % item for item in config.items())
+    return "\n".join(lines) + "\n" + reindent(ast.unparse(tree))
+
+
+def read_config(path):
+    """NAME = value lines of a config file as a dict"""
+    with open(path) as f:
+        tree = ast.parse(f.read(), path)
+    config = {}
+    for stmt in tree.body:
+        if not (isinstance(stmt, ast.Assign) and len(stmt.targets) == 1 and isinstance(stmt.targets[0], ast.Name)):
+            raise BuildError("%s line %d: NAME = value expected" % (path, stmt.lineno))
+        try:
+            config[stmt.targets[0].id] = ast.literal_eval(stmt.value)
+        except ValueError:
+            raise BuildError("%s line %d: the value must be a plain value" % (path, stmt.lineno))
+    return config
+
+
+def early_consts(text):
+    """
+    const() names used above their definition - on the hub the name is only put in
+    where it comes after the const(), and a _ name isn't kept as a global either.
+    The simulator's const() is a plain function, so the runs can't show it
+
+    Returns:
+        list: what is wrong - empty if every use comes after the definition
+    """
+    tree = ast.parse(text)
+    defined = {}
+    for stmt in tree.body:
+        if isinstance(stmt, ast.Assign) and const(stmt.value):
+            defined.setdefault(stmt.targets[0].id, stmt.lineno)
+    found = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and node.id in defined and node.lineno < defined[node.id]:
+            found.append((node.lineno, "line %d: %s used before its const() on line %d"
+                          % (node.lineno, node.id, defined[node.id])))
+    return [line for _, line in sorted(found)]
+
+
+def check(script, built, config, until=20000):
+    """
+    Run the original and the built script in the simulator with the same presses
+
+    Returns:
+        list: what differs - empty if the motors and lights did the same
+    """
+    from sim.world import Press, RemotePlan, World
+
+    with open(built) as f:
+        found = early_consts(f.read())
+
+    presses = [Press(1000, "LEFT_PLUS"), Press(1400, "LEFT_PLUS"), Press(1800, "LEFT_PLUS"),
+               Press(6000, "LEFT_MINUS", hold=1500), Press(9000, "LEFT"), Press(11000, "LEFT_MINUS"),
+               Press(14000, "LEFT"), Press(14050, "LEFT")]
+    runs = []
+    for path, overrides in ((script, config), (built, {})):
+        with World(strict=False) as world:
+            hub = world.add_hub(path, remote=RemotePlan(presses=presses), overrides=overrides)
+            world.run(until=until)
+            runs.append(hub)
+    original, build_ = runs
+    for hub in runs:
+        if hub.error is not None:
+            found.append("%s: %r" % (hub.script, hub.error))
+    for port in sorted(set(original.motors) | set(build_.motors)):
+        a = original.motors.get(port)
+        b = build_.motors.get(port)
+        if (a and a.history) != (b and b.history):
+            found.append("motor %s differs" % port)
+    if original.lights != build_.lights:
+        found.append("hub light differs")
+    if original.remote_lights != build_.remote_lights:
+        found.append("remote light differs")
+    return found
+
+
+def setting(text):
+    key, _, value = text.partition("=")
+    try:
+        value = ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        pass
+    return key, value
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m sim.build", description=__doc__.splitlines()[1])
+    parser.add_argument("script", help="script to build from")
+    parser.add_argument("-o", "--output", required=True, help="built script")
+    parser.add_argument("--config", help="file of NAME = value lines for this hub")
+    parser.add_argument("--set", type=setting, action="append", default=[], metavar="NAME=VALUE",
+                        help="a user defined value - after --config")
+    parser.add_argument("--mpy", action="store_true", help="also compile the build with mpy-cross")
+    parser.add_argument("--check", action="store_true",
+                        help="run the script and the build in the simulator and compare them")
+    args = parser.parse_args(argv)
+
+    config = read_config(args.config) if args.config else {}
+    config.update(args.set)
+    with open(args.script) as f:
+        source = f.read()
+    try:
+        text = build(source, config, os.path.basename(args.config or args.script))
+    except BuildError as ex:
+        sys.exit("build failed: %s" % ex)
+
+    folder = os.path.dirname(args.output)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    with open(args.output, "w") as f:
+        f.write(text)
+    print("%s: %d -> %d bytes, %d -> %d lines" % (args.output, len(source.encode()), len(text.encode()),
+                                                  source.count("\n"), text.count("\n")))
+
+    if args.mpy:
+        mpy_cross = shutil.which("mpy-cross")
+        if mpy_cross is None:
+            sys.exit("mpy-cross not found - pip install mpy-cross")
+        subprocess.run([mpy_cross, args.output], check=True)
+        print("%s: %d bytes" % (os.path.splitext(args.output)[0] + ".mpy",
+                               os.path.getsize(os.path.splitext(args.output)[0] + ".mpy")))
+
+    if args.check:
+        found = check(args.script, args.output, config)
+        for line in found:
+            print("CHECK", line)
+        if found:
+            sys.exit(1)
+        print("check: motors and lights the same as %s" % args.script)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,35 @@
+"""
+Stand-in for the MicroPython gc module
+
+CPython's own gc module is built in and can't be replaced on sys.path, so
+scripts get this one through sim.world.STANDINS. The heap is a simple model:
+run_task() uses ALLOC_PER_PASS bytes each loop pass and a full heap is
+collected automatically, stalling the hub for GC_PAUSE ms. The script's own
+allocations are not seen - mem_alloc() only moves with the loop passes.
+"""
+
+from sim.world import HEAP_SIZE, current
+
+
+def collect():
+    current().collect()
+
+
+def mem_alloc():
+    return current().heap_used
+
+
+def mem_free():
+    return HEAP_SIZE - current().heap_used
+
+
+def enable():
+    pass
+
+
+def disable():
+    pass
+
+
+def isenabled():
+    return True
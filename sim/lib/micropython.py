@@ -0,0 +1,8 @@
+"""
+Stand-in for the MicroPython micropython module
+"""
+
+
+def const(value):
+    """Compile time constant on the hub - just the value here"""
+    return value
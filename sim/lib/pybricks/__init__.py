@@ -0,0 +1,8 @@
+"""
+Host-side stand-in for the Pybricks firmware modules
+
+Only the parts of the API used by the PyTrain scripts are provided. All state
+lives on the simulated hub of the calling thread - see sim/world.py.
+"""
+
+version = ("sim", "3.6.1", "PyTrain simulator")
@@ -0,0 +1,148 @@
+"""
+Stand-in for pybricks.hubs
+"""
+
+from sim.world import current
+from pybricks.tools import done
+
+BROADCAST_LIMIT = 26    # max encoded advertisement size in bytes
+
+
+def _size(value):
+    """Approximate encoded size of one broadcast value in bytes ( 1 byte header each )"""
+    if value is None or isinstance(value, bool):
+        return 1
+    if isinstance(value, int):
+        if -128 <= value < 128:
+            return 2
+        if -32768 <= value < 32768:
+            return 3
+        return 5
+    if isinstance(value, float):
+        return 5
+    if isinstance(value, (str, bytes, bytearray)):
+        return 1 + len(value)
+    raise TypeError("can't broadcast %s" % type(value).__name__)
+
+
+def payload_size(data):
+    """Encoded size of a broadcast() argument in bytes"""
+    if isinstance(data, (tuple, list)):
+        return 1 + sum(_size(v) for v in data)
+    return 1 + _size(data)
+
+
+class _Light:
+    def __init__(self, hub):
+        self._hub = hub
+
+    def on(self, color):
+        self._hub.lights.append((self._hub.now, color))
+
+    def off(self):
+        self._hub.lights.append((self._hub.now, None))
+
+
+class _Battery:
+    def __init__(self, hub):
+        self._hub = hub
+
+    def voltage(self):
+        return int(self._hub.voltage)
+
+    def current(self):
+        # idle draw plus a simple load line for each running motor - mA as an int like the firmware
+        return int(60 + sum(m.current() for m in self._hub.motors.values()))
+
+
+class _System:
+    def __init__(self, hub):
+        self._hub = hub
+
+    def name(self):
+        return self._hub.name
+
+    def set_stop_button(self, button):
+        self._hub.stop_button = None if button is None else button.name
+
+    def shutdown(self):
+        self._hub.shutdown_at = self._hub.now
+        raise SystemExit("shutdown")
+
+    def storage(self, offset, write=None, read=None):
+        data = self._hub.storage
+        if write is not None:
+            if offset < 0 or offset + len(write) > len(data):
+                raise ValueError("storage out of range")
+            data[offset:offset + len(write)] = write
+            return None
+        if offset < 0 or offset + read > len(data):
+            raise ValueError("storage out of range")
+        return bytes(data[offset:offset + read])
+
+
+class _BLE:
+    def __init__(self, hub):
+        self._hub = hub
+
+    def broadcast(self, data):
+        hub = self._hub
+        if hub.broadcast_channel is None:
+            raise RuntimeError("broadcast channel not set")
+        if data is not None and payload_size(data) > BROADCAST_LIMIT:
+            raise ValueError("broadcast data too big")
+        if isinstance(data, list):
+            data = tuple(data)
+        hub.world.advertise(hub, hub.broadcast_channel, data)
+        hub.adverts += 1
+        return done()
+
+    def observe(self, channel):
+        hub = self._hub
+        if channel not in hub.observe_channels:
+            raise ValueError("channel not allocated")
+        return hub.world.observe(channel)
+
+    def signal_strength(self, channel):
+        return -128 if self.observe(channel) is None else -60
+
+    def version(self):
+        return "sim"
+
+
+class _Buttons:
+    def __init__(self, hub):
+        self._hub = hub
+
+    def pressed(self):
+        from pybricks.parameters import Button
+        hub = self._hub
+        hub.poll_cost()
+        names = hub.buttons.pressed(hub.now)
+        if hub.stop_button in names:
+            raise SystemExit("stop button")
+        return {Button[name] for name in names}
+
+
+class ThisHub:
+    """
+    The hub the script runs on
+
+    Args:
+        broadcast_channel (int): channel for hub.ble.broadcast() - None to disable
+        observe_channels (list): channels hub.ble.observe() may read
+    """
+    def __init__(self, broadcast_channel=None, observe_channels=()):
+        hub = current()
+        hub.broadcast_channel = broadcast_channel
+        hub.observe_channels = tuple(observe_channels)
+        self.light = _Light(hub)
+        self.battery = _Battery(hub)
+        self.system = _System(hub)
+        self.ble = _BLE(hub)
+        self.buttons = _Buttons(hub)
+
+
+CityHub = ThisHub
+TechnicHub = ThisHub
+MoveHub = ThisHub
@@ -0,0 +1,28 @@
+"""
+Stand-in for pybricks.iodevices
+"""
+
+from errno import ENODEV
+
+from sim.world import current
+
+PROBE_TIME = 100    # ms to identify the device on a port
+
+
+class PUPDevice:
+    """
+    Generic Powered Up device - the id comes from the devices given to World.add_hub()
+
+    Raises:
+        OSError: ENODEV if nothing is plugged into port
+    """
+    def __init__(self, port):
+        hub = current()
+        hub.sleep_until(hub.now + PROBE_TIME)
+        if port.name not in hub.devices:
+            raise OSError(ENODEV, "no device on port %s" % port.name)
+        self.port = port
+        self._id = hub.devices[port.name]
+
+    def info(self):
+        return {"id": self._id}
@@ -0,0 +1,88 @@
+"""
+Stand-in for pybricks.parameters
+"""
+
+
+class _Constant:
+    """Named enum-like constant e.g. Button.LEFT_PLUS"""
+    def __init__(self, group, name):
+        self._group = group
+        self.name = name
+
+    def __repr__(self):
+        return "%s.%s" % (self._group, self.name)
+
+    def __hash__(self):
+        return hash((self._group, self.name))
+
+    def __eq__(self, other):
+        return isinstance(other, _Constant) and (self._group, self.name) == (other._group, other.name)
+
+
+class _Enum:
+    """Class whose attributes are _Constants created from names"""
+    def __init__(self, group, names):
+        self._group = group
+        for name in names:
+            setattr(self, name, _Constant(group, name))
+
+    def __getitem__(self, name):
+        return getattr(self, name)
+
+    def __repr__(self):
+        return self._group
+
+
+Button = _Enum("Button", ("LEFT", "LEFT_PLUS", "LEFT_MINUS", "RIGHT", "RIGHT_PLUS",
+                          "RIGHT_MINUS", "CENTER", "UP", "DOWN", "BLUETOOTH", "BEACON"))
+Direction = _Enum("Direction", ("CLOCKWISE", "COUNTERCLOCKWISE"))
+Port = _Enum("Port", ("A", "B", "C", "D", "E", "F"))
+Stop = _Enum("Stop", ("COAST", "BRAKE", "HOLD", "NONE", "COAST_SMART"))
+Side = _Enum("Side", ("TOP", "BOTTOM", "FRONT", "BACK", "LEFT", "RIGHT"))
+
+
+class Color:
+    """
+    Hue, saturation, value colour - multiplying by a number scales the brightness
+
+    Args:
+        h (int): hue 0 - 359
+        s (int): saturation 0 - 100
+        v (int): value ( brightness ) 0 - 100
+    """
+    def __init__(self, h, s=100, v=100):
+        self.h = int(h) % 360
+        self.s = max(0, min(100, int(s)))
+        self.v = max(0, min(100, int(v)))
+
+    def __mul__(self, scale):
+        return Color(self.h, self.s, round(self.v * scale))
+
+    __rmul__ = __mul__
+
+    def __truediv__(self, scale):
+        return self * (1 / scale)
+
+    def __eq__(self, other):
+        return isinstance(other, Color) and (self.h, self.s, self.v) == (other.h, other.s, other.v)
+
+    def __hash__(self):
+        return hash((self.h, self.s, self.v))
+
+    def __repr__(self):
+        return "Color(h=%d, s=%d, v=%d)" % (self.h, self.s, self.v)
+
+
+Color.NONE = Color(0, 0, 0)
+Color.BLACK = Color(0, 0, 10)
+Color.GRAY = Color(0, 0, 50)
+Color.WHITE = Color(0, 0, 100)
+Color.RED = Color(0)
+Color.ORANGE = Color(30)
+Color.BROWN = Color(30, 100, 50)
+Color.YELLOW = Color(60)
+Color.GREEN = Color(120)
+Color.CYAN = Color(180)
+Color.BLUE = Color(240)
+Color.VIOLET = Color(270)
+Color.MAGENTA = Color(300)
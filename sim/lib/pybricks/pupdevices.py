@@ -0,0 +1,199 @@
+"""
+Stand-in for pybricks.pupdevices
+
+Motors keep a history of every duty cycle they receive. Encoder motors also
+run a simple first order speed model so speed() and angle() move plausibly.
+"""
+
+from errno import ENOTCONN, ETIMEDOUT
+from math import exp
+
+from sim.world import current
+from pybricks.parameters import Direction
+from pybricks.tools import done
+
+REMOTE_CONNECT_TIME = 500   # ms to pair once the remote is found
+RATED_SPEED = 1000          # deg/s of an encoder motor at 100 % dc and no load
+BREAKAWAY = 15              # % dc needed before the train moves
+TIME_CONSTANT = 150         # ms for the motor speed to settle
+AMPS_PER_DC = 8             # mA drawn per % dc
+STALL_PER_DC = 20           # mA drawn per % dc while the motor is stalled ( no back EMF )
+BLOCKED = 100               # load at which a motor can't turn at all, even under speed control
+
+
+class DCMotor:
+    """
+    Motor without rotation sensors
+
+    The load attribute ( % dc lost to grades and drag ) moves the breakaway point:
+    below it the motor is stalled and draws STALL_PER_DC mA per % dc.
+
+    Args:
+        port (Port): port the motor is plugged into
+        positive_direction (Direction): which way is positive
+    """
+    def __init__(self, port, positive_direction=Direction.CLOCKWISE):
+        self._hub = current()
+        self.port = port
+        self.direction = positive_direction
+        self.history = [(self._hub.now, 0)]
+        self.load = 0
+        self._hub.motors[port.name] = self
+
+    def dc(self, duty):
+        if duty != self.history[-1][1]:
+            self.history.append((self._hub.now, duty))
+
+    def stop(self):
+        self.dc(0)
+
+    def brake(self):
+        self.dc(0)
+
+    def current(self):
+        duty = abs(self.history[-1][1])
+        if duty < BREAKAWAY + self.load:
+            return STALL_PER_DC * duty
+        return AMPS_PER_DC * duty
+
+
+class Motor(DCMotor):
+    """
+    Motor with rotation sensors
+
+    The load attribute ( % dc lost to grades and drag ) can be changed by a
+    test while the world is paused to simulate changing track conditions.
+    A load of BLOCKED or more stops the motor turning ( derailed or jammed ).
+    """
+    def __init__(self, port, positive_direction=Direction.CLOCKWISE, gears=None,
+                 reset_angle=True, profile=None):
+        super().__init__(port, positive_direction)
+        self._speed = 0.0
+        self._angle = 0.0
+        self._target = None
+        self._t = self._hub.now
+
+    def _update(self):
+        now = self._hub.now
+        dt = now - self._t
+        if dt <= 0:
+            return
+        if self.load >= BLOCKED:
+            goal = 0
+        elif self._target is not None:
+            goal = self._target
+        else:
+            duty = self.history[-1][1]
+            drive = max(0, abs(duty) - BREAKAWAY - self.load)
+            goal = RATED_SPEED * drive / (100 - BREAKAWAY) * (1 if duty >= 0 else -1)
+        k = 1 - exp(-dt / TIME_CONSTANT)
+        speed = self._speed + (goal - self._speed) * k
+        self._angle += (self._speed + speed) / 2 * dt / 1000
+        self._speed = speed
+        self._t = now
+
+    def dc(self, duty):
+        self._update()
+        self._target = None
+        super().dc(duty)
+
+    def run(self, speed):
+        self._update()
+        self._target = speed
+        self.history.append((self._hub.now, ("run", speed)))
+
+    def stop(self):
+        self.dc(0)
+
+    def hold(self):
+        self.run(0)
+
+    def speed(self, window=None):
+        self._update()
+        return round(self._speed)
+
+    def angle(self):
+        self._update()
+        return round(self._angle)
+
+    def reset_angle(self, angle=0):
+        self._update()
+        self._angle = angle
+
+    def current(self):
+        self._update()
+        duty = self.history[-1][1]
+        if not isinstance(duty, (int, float)):
+            # speed control pushes up to full power against a blocked motor
+            duty = 100 if self.load >= BLOCKED else 100 * abs(self._target) // RATED_SPEED
+        duty = abs(duty)
+        if duty < BREAKAWAY + self.load:
+            return STALL_PER_DC * duty
+        return AMPS_PER_DC * duty
+
+
+class _RemoteButtons:
+    def __init__(self, remote):
+        self._remote = remote
+
+    def pressed(self):
+        remote = self._remote
+        remote._check()
+        remote._hub.poll_cost()
+        from pybricks.parameters import Button
+        return {Button[name] for name in remote._plan.pressed(remote._hub.now)}
+
+
+class _RemoteLight:
+    def __init__(self, remote):
+        self._remote = remote
+
+    def on(self, color):
+        self._remote._check()
+        self._remote._hub.remote_lights.append((self._remote._hub.now, color))
+        return done()
+
+    def off(self):
+        return self.on(None)
+
+
+class Remote:
+    """
+    LEGO Powered Up remote - behaviour comes from the RemotePlan given to World.add_hub()
+
+    Args:
+        name (str): name of the remote to connect to - None for any
+        timeout (int): ms to search before giving up - None to search forever
+
+    Raises:
+        OSError: ETIMEDOUT if no remote was found in time
+    """
+    def __init__(self, name=None, timeout=10000):
+        hub = current()
+        plan = hub.remote
+        found = plan.next_available(hub.now) if plan is not None else None
+        if found is None or (timeout is not None and found > hub.now + timeout):
+            hub.sleep_until(float("inf") if timeout is None else hub.now + timeout)
+            raise OSError(ETIMEDOUT, "remote not found")
+        hub.sleep_until(found + REMOTE_CONNECT_TIME)
+        self._hub = hub
+        self._plan = plan
+        self._since = hub.now
+        self._closed = False
+        self.buttons = _RemoteButtons(self)
+        self.light = _RemoteLight(self)
+
+    def _check(self):
+        if self._closed:
+            raise OSError(ENOTCONN, "remote disconnected")
+        now = self._hub.now
+        for start, end in self._plan.drops:
+            if self._since < end and start <= now:
+                raise OSError(ENOTCONN, "remote disconnected")
+
+    def name(self, name=None):
+        self._check()
+        return self._plan.name
+
+    def disconnect(self):
+        self._closed = True
@@ -0,0 +1,134 @@
+"""
+Stand-in for pybricks.tools
+
+run_task() steps the main coroutine once every loop_time virtual ms, just like
+the firmware event loop. Inside run_task() wait() returns an awaitable, outside
+it blocks by advancing the virtual clock.
+"""
+
+from sim.world import ALLOC_PER_PASS, current
+
+
+class _Wait:
+    """Awaitable that yields at least once and until time ms have passed"""
+    def __init__(self, hub, time):
+        self._hub = hub
+        self._end = hub.now + time
+
+    def __await__(self):
+        yield
+        while self._hub.now < self._end:
+            yield
+
+
+class _Done:
+    """Awaitable for a radio operation that completes on the next loop pass"""
+    def __await__(self):
+        yield
+
+
+def wait(time):
+    """
+    Pause for time ms - awaitable inside run_task()
+
+    Args:
+        time (int|float): ms to wait
+    """
+    hub = current()
+    if hub.async_active:
+        return _Wait(hub, time)
+    hub.sleep_until(hub.now + time)
+
+
+def done():
+    """Result of a radio call: an awaitable inside run_task(), None outside"""
+    return _Done() if current().async_active else None
+
+
+class StopWatch:
+    """Stopwatch on the virtual clock ( ms )"""
+    def __init__(self):
+        self._hub = current()
+        self._start = self._hub.now
+        self._paused = None
+
+    def time(self):
+        end = self._paused if self._paused is not None else self._hub.now
+        return end - self._start
+
+    def pause(self):
+        if self._paused is None:
+            self._paused = self._hub.now
+
+    def resume(self):
+        if self._paused is not None:
+            self._start += self._hub.now - self._paused
+            self._paused = None
+
+    def reset(self):
+        self._start = self._hub.now
+        if self._paused is not None:
+            self._paused = self._start
+
+
+class _MultiTask:
+    def __init__(self, tasks, race):
+        self._tasks = tasks
+        self._race = race
+
+    def __await__(self):
+        tasks = [t.__await__() for t in self._tasks]
+        results = [None] * len(tasks)
+        running = list(range(len(tasks)))
+        try:
+            while running:
+                for i in list(running):
+                    try:
+                        tasks[i].send(None)
+                    except StopIteration as ex:
+                        results[i] = ex.value
+                        running.remove(i)
+                        if self._race:
+                            return results
+                if running:
+                    yield
+            return results
+        finally:
+            for i in running:
+                tasks[i].close()
+
+
+def multitask(*tasks, race=False):
+    """
+    Run coroutines side by side, one step each per loop pass
+
+    Args:
+        tasks: coroutines or other awaitables
+        race (bool): finish as soon as one of them finishes and cancel the rest
+    """
+    return _MultiTask(tasks, race)
+
+
+def run_task(task, loop_time=None):
+    """
+    Run the coroutine task to completion on the virtual clock
+
+    Args:
+        task: coroutine
+        loop_time (int): ms between loop passes - defaults to the hub loop_time
+    """
+    hub = current()
+    if loop_time is None:
+        loop_time = hub.loop_time
+    hub.async_active = True
+    try:
+        while True:
+            try:
+                task.send(None)
+            except StopIteration as ex:
+                return ex.value
+            hub.allocate(ALLOC_PER_PASS)
+            hub.sleep_until(hub.now + loop_time)
+    finally:
+        hub.async_active = False
+        task.close()
@@ -0,0 +1,5 @@
+"""
+Stand-in for the MicroPython umath module
+"""
+
+from math import *  # noqa: F401,F403
@@ -0,0 +1,5 @@
+"""
+Stand-in for the MicroPython ustruct module
+"""
+
+from struct import calcsize, pack, pack_into, unpack, unpack_from  # noqa: F401
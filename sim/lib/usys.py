@@ -0,0 +1,27 @@
+"""
+Stand-in for the MicroPython usys module
+
+Text written to stdout goes to the hub output like print(), bytes written
+to stdout.buffer are kept in hub.binary ( e.g. a trace dump )
+"""
+
+from sim.world import current
+
+
+class _Buffer:
+    """Binary side of stdout"""
+    def write(self, data):
+        current().binary += bytes(data)
+        return len(data)
+
+
+class _Stdout:
+    """stdout - text goes to the hub output"""
+    buffer = _Buffer()
+
+    def write(self, text):
+        current().print(text, end="")
+        return len(text)
+
+
+stdout = _Stdout()
@@ -0,0 +1,86 @@
+"""
+Decoder for the TRACE dumps of pytrain.py
+
+pytrain.py with TRACE set keeps a ring buffer of records in memory and writes
+it to stdout as binary when the right red button is pressed or the programme
+is stopped. Capture the hub output to a file ( e.g. with pybricksdev, or
+--dump in the simulator ) and turn it into CSV:
+
+    python -m sim.trace trace.bin                # CSV on stdout
+    python -m sim.trace trace.bin -o trace.csv
+
+Text printed around the dumps is skipped. Each dump found becomes a block of
+rows numbered in the dump column.
+"""
+
+import argparse
+import csv
+import struct
+import sys
+
+# must match pytrain.py
+TRACE_FORMAT = "<IbbbHB"    # clock ms, cc, target, dc, mV, task
+TRACE_HEADER = "<4sBBH"     # magic, version, record size, record count
+TRACE_MAGIC = b"PTTR"
+TRACE_VERSION = 1
+TASKS = {1: "drive", 2: "ems", 3: "controller", 4: "broadcast", 5: "battery", 6: "monitor"}
+COLUMNS = ("dump", "ms", "task", "cc", "target", "dc", "mv")
+
+
+def dumps(data):
+    """
+    Find every trace dump in data
+
+    Args:
+        data (bytes): captured hub output
+
+    Yields:
+        list: (ms, cc, target, dc, mv, task) tuples of one dump, oldest first
+    """
+    header = struct.calcsize(TRACE_HEADER)
+    pos = data.find(TRACE_MAGIC)
+    while pos >= 0:
+        if pos + header > len(data):
+            break
+        _, version, size, count = struct.unpack_from(TRACE_HEADER, data, pos)
+        start = pos + header
+        end = start + size * count
+        if version != TRACE_VERSION or size != struct.calcsize(TRACE_FORMAT) or end > len(data):
+            # not a dump after all, or cut short - look further on
+            pos = data.find(TRACE_MAGIC, pos + 1)
+            continue
+        yield [struct.unpack_from(TRACE_FORMAT, data, start + i * size) for i in range(count)]
+        pos = data.find(TRACE_MAGIC, end)
+
+
+def write_csv(data, out):
+    """Write every dump in data to out as CSV - returns the number of dumps"""
+    writer = csv.writer(out)
+    writer.writerow(COLUMNS)
+    n = 0
+    for n, records in enumerate(dumps(data), 1):
+        for ms, cc, target, dc, mv, task in records:
+            writer.writerow((n, ms, TASKS.get(task, task), cc, target, dc, mv))
+    return n
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m sim.trace", description=__doc__.splitlines()[1])
+    parser.add_argument("file", help="captured hub output")
+    parser.add_argument("-o", "--output", help="CSV file to write - default stdout")
+    args = parser.parse_args(argv)
+
+    with open(args.file, "rb") as f:
+        data = f.read()
+    if args.output:
+        with open(args.output, "w", newline="") as out:
+            n = write_csv(data, out)
+        print("%d dumps written to %s" % (n, args.output))
+    else:
+        n = write_csv(data, sys.stdout)
+    if not n:
+        sys.exit("no trace dump found in %s" % args.file)
+
+
+if __name__ == "__main__":
+    main()
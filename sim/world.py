@@ -0,0 +1,369 @@
+"""
+Virtual world for running Pybricks scripts on a host computer
+
+A World owns a virtual millisecond clock and any number of simulated hubs.
+Each hub runs an unmodified script (pytrain.py, pytrainfollow.py ...) in its
+own thread, but only one hub runs at a time and the clock only moves when a
+hub waits - so every run is deterministic and much faster than real time.
+
+The pybricks stand-in modules in sim/lib look up the hub of the calling
+thread with current() and keep all their state on it.
+"""
+
+import builtins
+import importlib
+import os
+import re
+import sys
+import threading
+import traceback
+import warnings
+
+LIB = os.path.join(os.path.dirname(os.path.abspath(__file__)), "lib")
+if LIB not in sys.path:
+    sys.path.insert(0, LIB)
+
+# --- simulation constants
+SYNC_POLL_COST = 1      # virtual ms used by a blocking poll outside run_task() ( busy loops )
+BLE_LATENCY = 30        # ms before an advertisement can be seen by an observing hub
+STORAGE_SIZE = 512      # bytes of user storage on the hub
+LOOP_TIME = 10          # default run_task() loop time (ms)
+HEAP_SIZE = 20000       # bytes of MicroPython heap
+HEAP_BASE = 8000        # bytes still in use after a collection ( script and objects )
+ALLOC_PER_PASS = 16     # bytes allocated by the firmware and script each run_task() loop pass
+GC_PAUSE = 4            # virtual ms a garbage collection stops the hub for
+
+# script imports served by a stand-in although CPython has a built in module of that name
+STANDINS = {"gc": "_gc"}
+
+# MicroPython doesn't warn about tasks that are created but never run
+warnings.filterwarnings("ignore", "coroutine .* was never awaited", RuntimeWarning)
+
+_local = threading.local()
+_ansi = re.compile(r"\x1b\[[0-9;]*[A-Za-z]")
+
+
+class Halt(BaseException):
+    """Raised inside a hub thread to stop it when the world is closed"""
+
+
+def current():
+    """
+    Return the simulated hub running in this thread
+
+    Raises:
+        RuntimeError: if a pybricks stand-in is used outside World.run()
+    """
+    hub = getattr(_local, "hub", None)
+    if hub is None:
+        raise RuntimeError("pybricks stand-in used outside a simulated hub")
+    return hub
+
+
+def _import(name, *args, **kwargs):
+    """__import__ for scripts - see STANDINS"""
+    if name in STANDINS:
+        return importlib.import_module(STANDINS[name])
+    return builtins.__import__(name, *args, **kwargs)
+
+
+class Press:
+    """
+    One press of one or more remote buttons
+
+    Args:
+        at (int): virtual ms when the buttons go down
+        buttons (str): Button names e.g. "LEFT_PLUS"
+        hold (int): ms the buttons are held down
+    """
+    def __init__(self, at, *buttons, hold=100):
+        self.at = at
+        self.buttons = buttons
+        self.hold = hold
+
+    def __repr__(self):
+        return "Press(%d,%s,hold=%d)" % (self.at, "+".join(self.buttons), self.hold)
+
+
+class RemotePlan:
+    """
+    Scripted behaviour of the LEGO remote during a run
+
+    Args:
+        connect (int): virtual ms at which the remote is switched on - None for never
+        presses (list): Press entries, in any order
+        drops (list): (start, end) ms windows where the remote is out of range
+        name (str): name reported by remote.name()
+    """
+    def __init__(self, connect=0, presses=(), drops=(), name="Handset"):
+        self.connect = connect
+        self.presses = sorted(presses, key=lambda p: p.at)
+        self.drops = list(drops)
+        self.name = name
+
+    def press(self, at, *buttons, hold=100):
+        """Add a press and return it"""
+        p = Press(at, *buttons, hold=hold)
+        self.presses.append(p)
+        self.presses.sort(key=lambda p: p.at)
+        return p
+
+    def pressed(self, now):
+        """Names of the buttons held down at virtual time now"""
+        names = set()
+        for p in self.presses:
+            if p.at > now:
+                break
+            if now < p.at + p.hold:
+                names.update(p.buttons)
+        return names
+
+    def available(self, now):
+        """True if the remote is on and in range at virtual time now"""
+        if self.connect is None or now < self.connect:
+            return False
+        return not any(start <= now < end for start, end in self.drops)
+
+    def next_available(self, now):
+        """First virtual ms at or after now where the remote can be found - None if never"""
+        if self.connect is None:
+            return None
+        t = max(now, self.connect)
+        for start, end in sorted(self.drops):
+            if start <= t < end:
+                t = end
+        return t
+
+
+class SimHub:
+    """
+    One simulated hub running one script
+
+    Created with World.add_hub() - see there for the arguments.
+    After a run the histories below can be inspected:
+
+        motors        port letter -> stand-in motor ( motor.history is [(ms, dc)] )
+        lights        [(ms, Color)] hub status light
+        remote_lights [(ms, Color)] remote status light
+        output        [(ms, text)] everything the script printed
+        collections   [ms] garbage collections, automatic or by the script
+        binary        bytes the script wrote to usys.stdout.buffer
+        adverts       number of BLE advertisements sent
+    """
+    def __init__(self, world, index, script, name, remote, devices, overrides,
+                 storage, voltage, loop_time, buttons, start):
+        self.world = world
+        self.index = index
+        self.script = script
+        self.name = name
+        self.remote = remote
+        self.buttons = RemotePlan(presses=buttons)
+        self.stop_button = "CENTER"
+        self.devices = dict(devices)
+        self.overrides = dict(overrides)
+        self.storage = bytearray(STORAGE_SIZE)
+        self.storage[:len(storage)] = storage
+        self.voltage = voltage
+        self.loop_time = loop_time
+        self.motors = {}
+        self.lights = []
+        self.remote_lights = []
+        self.output = []
+        self.binary = bytearray()
+        self.heap_used = HEAP_BASE
+        self.collections = []
+        self.adverts = 0
+        self.broadcast_channel = None
+        self.observe_channels = ()
+        self.async_active = False
+        self.next_time = start
+        self.exit = None
+        self.shutdown_at = None
+        self.error = None
+        self.done = False
+        self._go = threading.Event()
+        self._thread = None
+
+    @property
+    def now(self):
+        return self.world.now
+
+    def sleep_until(self, t):
+        """Hand the clock back to the world until virtual time t"""
+        self.next_time = max(t, self.world.now)
+        self._go.clear()
+        self.world._back.set()
+        self._go.wait()
+        if self.world._halting:
+            raise Halt
+
+    def poll_cost(self):
+        """Charge a blocking poll made outside run_task() so busy loops advance the clock"""
+        if not self.async_active:
+            self.sleep_until(self.world.now + SYNC_POLL_COST)
+
+    def allocate(self, size):
+        """Use size bytes of heap - a full heap is collected first, just like MicroPython"""
+        if self.heap_used + size > HEAP_SIZE:
+            self.collect()
+        self.heap_used += size
+
+    def collect(self):
+        """Garbage collection - frees the heap down to HEAP_BASE and stalls the hub GC_PAUSE ms"""
+        self.collections.append(self.world.now)
+        self.heap_used = HEAP_BASE
+        self.sleep_until(self.world.now + GC_PAUSE)
+
+    def print(self, *args, sep=" ", end="\n", file=None, flush=False):
+        """Replacement for print() in the script - records output with its virtual time"""
+        text = sep.join(str(a) for a in args) + end
+        self.output.append((self.world.now, text))
+        if self.world.echo:
+            text = _ansi.sub("", text)
+            for line in text.splitlines():
+                sys.stdout.write("[%8d] %s: %s\n" % (self.world.now, self.name, line))
+
+    def source(self):
+        """Script source with the user defined values replaced by the overrides"""
+        with open(self.script) as f:
+            source = f.read()
+        for key, value in self.overrides.items():
+            pattern = re.compile(r"^%s[ \t]*=[ \t]*[^#\n]*" % re.escape(key), re.M)
+            source, n = pattern.subn(lambda m: "%s = %r " % (key, value), source, count=1)
+            if not n:
+                raise KeyError("%s is not a user defined value in %s" % (key, self.script))
+        return source
+
+    def _main(self):
+        _local.hub = self
+        self._go.wait()
+        try:
+            if self.world._halting:
+                raise Halt
+            code = compile(self.source(), self.script, "exec")
+            exec(code, {"__name__": "__main__", "__file__": self.script, "print": self.print,
+                        "__builtins__": dict(vars(builtins), __import__=_import)})
+            self.exit = "finished"
+        except Halt:
+            pass
+        except SystemExit as ex:
+            self.exit = ex.code if ex.code is not None else "exit"
+        except BaseException as ex:
+            self.error = ex
+            self.exit = "error"
+            if self.world.echo:
+                traceback.print_exc()
+        finally:
+            self.done = True
+            self.world._back.set()
+
+    def dc(self, port="A"):
+        """Duty cycle last sent to the motor on port ( 0 if none )"""
+        m = self.motors.get(port)
+        return m.history[-1][1] if m and m.history else 0
+
+
+class World:
+    """
+    Virtual clock, radio and set of simulated hubs
+
+    Args:
+        echo (bool): copy script output to stdout with virtual timestamps
+        strict (bool): re-raise the first script exception from run()
+
+    Example:
+        world = World()
+        remote = RemotePlan(presses=[Press(1000, "LEFT_PLUS")])
+        loco = world.add_hub("pytrain.py", remote=remote)
+        world.run(until=5000)
+        print(loco.motors["A"].history)
+        world.close()
+    """
+    def __init__(self, echo=False, strict=True):
+        self.now = 0
+        self.echo = echo
+        self.strict = strict
+        self.hubs = []
+        self.air = {}
+        self._back = threading.Event()
+        self._halting = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def add_hub(self, script, name=None, remote=None, devices=None, overrides=None,
+                storage=b"", voltage=8400, loop_time=LOOP_TIME, buttons=(), start=0):
+        """
+        Add a hub running script
+
+        Args:
+            script (str): path of the Pybricks script to run unmodified
+            name (str): hub name, defaults to the script name
+            remote (RemotePlan): remote behaviour - None for no remote at all
+            devices (dict): port letter -> PUPDevice id ( 1/2 = DC train motor, 38/46/48 ... = encoder motor )
+            overrides (dict): user defined values at the top of the script to replace
+            storage (bytes): initial content of hub user storage
+            voltage (int): battery voltage in mV
+            loop_time (int): ms between run_task() loop passes
+            buttons (list): Press entries for the hub's own button ( "CENTER" )
+            start (int): virtual ms the hub is switched on and starts the script
+        """
+        if devices is None:
+            devices = {"A": 2, "B": 2}
+        if name is None:
+            name = os.path.splitext(os.path.basename(script))[0]
+        hub = SimHub(self, len(self.hubs), script, name, remote, devices, overrides or {},
+                     storage, voltage, loop_time, buttons, start)
+        self.hubs.append(hub)
+        return hub
+
+    def run(self, until):
+        """
+        Run all hubs until virtual time until (ms) or until they have all finished
+        Can be called again with a later time to continue the same run
+        """
+        for hub in self.hubs:
+            if hub._thread is None:
+                hub._thread = threading.Thread(target=hub._main, name=hub.name, daemon=True)
+                hub._thread.start()
+        while True:
+            live = [h for h in self.hubs if not h.done]
+            if not live:
+                break
+            hub = min(live, key=lambda h: (h.next_time, h.index))
+            if hub.next_time > until:
+                break
+            self.now = max(self.now, hub.next_time)
+            self._back.clear()
+            hub._go.set()
+            self._back.wait()
+            if hub.error is not None and self.strict:
+                raise hub.error
+        self.now = max(self.now, until)
+
+    def close(self):
+        """Stop every hub thread that is still waiting"""
+        self._halting = True
+        for hub in self.hubs:
+            if hub._thread is not None and not hub.done:
+                self._back.clear()
+                hub._go.set()
+                hub._thread.join()
+
+    # --- radio
+
+    def advertise(self, hub, channel, data):
+        """Put data from hub on the air on channel - it is repeated until replaced"""
+        history = self.air.setdefault(channel, [])
+        history.append((self.now, data, hub))
+        del history[:-8]
+
+    def observe(self, channel):
+        """Latest data on channel an observer can see now - None if nothing is on the air"""
+        for t, data, hub in reversed(self.air.get(channel, ())):
+            if t + BLE_LATENCY <= self.now:
+                return None if hub.done else data
+        return None